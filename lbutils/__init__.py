@@ -1,8 +1,21 @@
+import django
+
 __version__ = '1.1.0'
 
+if django.VERSION < (3, 2):
+    default_app_config = 'lbutils.apps.LbutilsConfig'
+
+from .cacheutils import *  # NOQA
 from .dateutils import *  # NOQA
+from .exportcache import *  # NOQA
+from .exportdelta import *  # NOQA
+from .exportjobs import *  # NOQA
 from .forms import *  # NOQA
+from .paginator import *  # NOQA
+from .planner import *  # NOQA
 from .qs import *  # NOQA
+from .routing import *  # NOQA
+from .search import *  # NOQA
 from .utils import *  # NOQA
 from .views import *  # NOQA
 from .widgets import *  # NOQA
@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class LbutilsConfig(AppConfig):
+    name = 'lbutils'
+
+    def ready(self):
+        from .cacheutils import watch_model_versions
+        if getattr(settings, 'LBUTILS_CACHE', None):
+            watch_model_versions()
@@ -0,0 +1,140 @@
+import hashlib
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+__all__ = (
+    'get_lbutils_cache', 'get_model_version', 'bump_model_version',
+    'watch_model_versions', 'get_qs_models', 'get_qs_cache_key',
+)
+
+_watching = False
+
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def get_lbutils_cache():
+    """
+    cache used by lbutils, settings.LBUTILS_CACHE, default is 'default'.
+
+    The data versions of models are kept in it. Set LBUTILS_CACHE to a cache
+    shared by all processes(ex: redis, memcached) to invalidate the cached
+    results on the writes of every process, see `watch_model_versions` and
+    the check `lbutils.W001`.
+    """
+    return caches[getattr(settings, 'LBUTILS_CACHE', 'default')]
+
+
+@checks.register(checks.Tags.caches)
+def check_lbutils_cache(app_configs=None, **kwargs):
+    alias = getattr(settings, 'LBUTILS_CACHE', None)
+    if not alias:
+        return []
+    backend = getattr(settings, 'CACHES', {}).get(alias, {}).get('BACKEND', LOCAL_CACHE_BACKENDS[0])
+    if backend not in LOCAL_CACHE_BACKENDS:
+        return []
+    return [checks.Warning(
+        'The lbutils cache "%s" is not shared by processes.' % alias,
+        hint='Cached exports, aggregates and lookups are not invalidated by the writes of other '
+             'processes, set LBUTILS_CACHE to a shared cache.',
+        id='lbutils.W001')]
+
+
+def _version_key(model):
+    return 'lbutils:version:%s' % model._meta.label_lower
+
+
+def _new_version():
+    # never restart from a used version if the counter is evicted
+    return int(time.time() * 1000)
+
+
+def get_model_version(model):
+    """ get the data version of model, it changes when the data of model changes """
+    watch_model_versions()
+    cache = get_lbutils_cache()
+    key = _version_key(model)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_model_version(model):
+    """
+    change the data version of model.
+
+    Called by the signals of models, see `watch_model_versions`, call it after bulk operations
+    which do not send signals, ex: `qs.update()`, `bulk_create()`.
+    """
+    cache = get_lbutils_cache()
+    key = _version_key(model)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = _new_version()
+        cache.set(key, version, None)
+        return version
+
+
+def _on_save_or_delete(sender, **kwargs):
+    bump_model_version(sender)
+
+
+def _on_m2m_changed(sender, instance, model, action, **kwargs):
+    if action.startswith('post_'):
+        for e in {sender, type(instance), model}:
+            bump_model_version(e)
+
+
+def watch_model_versions():
+    """
+    bump the versions of models on post_save/post_delete/m2m_changed.
+
+    Connected at startup if settings.LBUTILS_CACHE is set, so the writes of
+    processes which never use a cached helper bump the versions too.
+    Else it is connected when a process first uses a cached helper,
+    and saves of projects which do not use them cost nothing.
+    """
+    global _watching
+    if _watching:
+        return
+    _watching = True
+    post_save.connect(_on_save_or_delete, dispatch_uid='lbutils:version')
+    post_delete.connect(_on_save_or_delete, dispatch_uid='lbutils:version')
+    m2m_changed.connect(_on_m2m_changed, dispatch_uid='lbutils:version')
+
+
+def get_qs_models(qs):
+    """ models of the tables used by the query of qs """
+    tables = {e.table_name for e in qs.query.alias_map.values()}
+    tables.add(qs.model._meta.db_table)
+    return sorted(
+        (e for e in apps.get_models(include_auto_created=True) if e._meta.db_table in tables),
+        key=lambda e: e._meta.label_lower)
+
+
+def get_qs_cache_key(prefix, qs, *extra):
+    """
+    cache key for the result of qs.
+
+    The key is made of the sql and params of qs, the data versions of the
+    models in the query and extra, so it changes when the data changes.
+    """
+    models = get_qs_models(qs)
+    try:
+        sql, params = qs.query.sql_with_params()
+    except EmptyResultSet:
+        sql, params = None, None
+    versions = [(e._meta.label_lower, get_model_version(e)) for e in models]
+    raw = repr((qs.db, sql, params, versions, extra))
+    return '%s:%s' % (prefix, hashlib.sha1(raw.encode('utf-8')).hexdigest())
@@ -0,0 +1,195 @@
+import functools
+import hashlib
+import os
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from .cacheutils import get_qs_cache_key
+
+__all__ = (
+    'private_dir', 'get_export_root', 'get_export_cache_dir', 'export_cache_key', 'get_cached_export',
+    'new_export_cache_file', 'save_cached_export', 'evict_export_cache',
+)
+
+
+def private_dir(path, shared=False):
+    """
+    create directory path with mode 0700 if not exists, and check it can not
+    be changed by other users, the exported data and jobs are kept there.
+
+    shared: the directory is configured in settings, it may be shared by the users
+        of the web and worker processes, only check it is not writable by others.
+    raise: ImproperlyConfigured if the directory is not safe
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.stat(path)
+    if shared:
+        unsafe = st.st_mode & 0o002
+    else:
+        unsafe = st.st_mode & 0o077 or (hasattr(os, 'getuid') and st.st_uid != os.getuid())
+    if unsafe:
+        raise ImproperlyConfigured(
+            'export directory %s must be owned by this user and not accessible by others' % path)
+    return path
+
+
+def get_export_root():
+    """
+    directory for export jobs and their files.
+
+    settings.LBUTILS_EXPORT_ROOT, default is `<tmp>/lbutils-exports-<uid>`
+    """
+    root = getattr(settings, 'LBUTILS_EXPORT_ROOT', None)
+    if root:
+        return private_dir(root, shared=True)
+    return private_dir(os.path.join(tempfile.gettempdir(), 'lbutils-exports-%s' % _uid()))
+
+
+def get_export_cache_dir():
+    """
+    directory of cached export files.
+
+    settings.LBUTILS_EXPORT_CACHE_DIR, default is `<tmp>/lbutils-export-cache-<uid>`
+    """
+    root = getattr(settings, 'LBUTILS_EXPORT_CACHE_DIR', None)
+    if root:
+        return private_dir(root, shared=True)
+    return private_dir(os.path.join(tempfile.gettempdir(), 'lbutils-export-cache-%s' % _uid()))
+
+
+def _uid():
+    return os.getuid() if hasattr(os, 'getuid') else 0
+
+
+def export_cache_key(filename, titles, qs, *extra):
+    """
+    key of an export file, see `lbutils.cacheutils.get_qs_cache_key`.
+
+    It changes when the data of the models used by qs changes.
+    extra: options which change the file, functions are keyed by their code
+        and closure, they should only depend on the exported object.
+    """
+    extra = [_func_key(e) if callable(e) else e for e in extra]
+    return get_qs_cache_key('export', qs, filename, list(titles), extra).replace(':', '-')
+
+
+def _func_key(func):
+    if isinstance(func, functools.partial):
+        return (_func_key(func.func), func.args, sorted(func.keywords.items()))
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return repr(func)
+    try:
+        cells = [e.cell_contents for e in func.__closure__ or ()]
+    except ValueError:  # empty cell
+        cells = None
+    return (
+        func.__module__, func.__qualname__, hashlib.sha1(code.co_code).hexdigest(),
+        code.co_consts, code.co_names, cells, getattr(func, '__self__', None))
+
+
+def _cache_path(key):
+    return os.path.join(get_export_cache_dir(), key)
+
+
+def get_cached_export(key, ttl):
+    """
+    get path of the cached export file, None if not cached or expired.
+
+    ttl: seconds the file is valid after it is created
+    """
+    path = _cache_path(key)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    now = time.time()
+    if st.st_mtime + ttl < now:
+        return None
+    os.utime(path, (now, st.st_mtime))  # atime is the last used time for LRU
+    return path
+
+
+def _tmp_dir():
+    return os.path.join(get_export_cache_dir(), 'tmp')
+
+
+def new_export_cache_file():
+    """
+    a temporary file to build an export file, pass its name to `save_cached_export`,
+    remove it if the export fails.
+    """
+    tmp_dir = _tmp_dir()
+    os.makedirs(tmp_dir, exist_ok=True)
+    return tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False)
+
+
+def save_cached_export(key, tmp_path, max_size=None):
+    """
+    move a finished export file to the cache and evict old files.
+
+    tmp_path: the export file, see `new_export_cache_file`
+    max_size: see `evict_export_cache`
+    return: path of the cached file
+    """
+    path = _cache_path(key)
+    os.replace(tmp_path, path)
+    evict_export_cache(max_size, keep=path)
+    return path
+
+
+def evict_export_cache(max_size=None, ttl=None, keep=None):
+    """
+    remove expired files, then the least recently used files until the
+    total size is not larger than max_size. Temporary files older than ttl
+    are left by crashed exports, they are removed too.
+
+    max_size: bytes, settings.LBUTILS_EXPORT_CACHE_MAX_SIZE, default is 1G
+    ttl: seconds, settings.LBUTILS_EXPORT_CACHE_TTL, default is 1 day
+    keep: path of a file which should not be removed
+    """
+    if max_size is None:
+        max_size = getattr(settings, 'LBUTILS_EXPORT_CACHE_MAX_SIZE', 1024 ** 3)
+    if ttl is None:
+        ttl = getattr(settings, 'LBUTILS_EXPORT_CACHE_TTL', 24 * 3600)
+    root = get_export_cache_dir()
+    now = time.time()
+    tmp_dir = _tmp_dir()
+    for fn in os.listdir(tmp_dir) if os.path.isdir(tmp_dir) else []:
+        path = os.path.join(tmp_dir, fn)
+        try:
+            if os.stat(path).st_mtime + ttl < now:
+                _remove(path)
+        except OSError:
+            continue
+    files = []
+    for fn in os.listdir(root):
+        path = os.path.join(root, fn)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if not os.path.isfile(path):
+            continue
+        if path != keep and st.st_mtime + ttl < now:
+            _remove(path)
+            continue
+        files.append((st.st_atime, st.st_size, path))
+    total = sum(e[1] for e in files)
+    for atime, size, path in sorted(files):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        _remove(path)
+        total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,101 @@
+import json
+import os
+import re
+
+from .exportcache import get_export_root
+from .qs import iter_keyset
+
+__all__ = (
+    'get_export_watermark', 'set_export_watermark', 'iter_delta_rows',
+)
+
+WATERMARK_NAME_RE = re.compile(r'^[\w.-]+$')
+
+
+def _watermark_path(name):
+    if not WATERMARK_NAME_RE.match(name or ''):
+        raise ValueError('invalid export name: %r' % name)
+    root = os.path.join(get_export_root(), 'watermarks')
+    os.makedirs(root, exist_ok=True)
+    return os.path.join(root, '%s.json' % name)
+
+
+def _json_default(o):
+    if hasattr(o, 'isoformat'):
+        return o.isoformat()  # keep microseconds, DjangoJSONEncoder drops them
+    return '%s' % o
+
+
+def get_export_watermark(name):
+    """
+    get the last exported key (value of watermark field, pk) of an export,
+    None if never exported.
+    """
+    try:
+        with open(_watermark_path(name)) as f:
+            return tuple(json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+def set_export_watermark(name, key):
+    """
+    set the last exported key of an export, set to None to export all rows next time.
+    """
+    path = _watermark_path(name)
+    if key is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(list(key), f, default=_json_default)
+    os.replace(tmp_path, path)
+
+
+def iter_delta_rows(name, qs, field='pk', func_data=None, columns=None, chunk_size=2000, save=True):
+    """
+    iterate the rows newer than the watermark of the last export, the
+    watermark is saved after the last row.
+
+    Rows are ordered by (field, pk) and fetched with `iter_keyset`.
+    name: export name, the watermark is stored in `<LBUTILS_EXPORT_ROOT>/watermarks/`
+    field: watermark field, ex: an auto-increment pk or 'updated_at'
+    func_data: see `lbutils.xlsxutils.iter_export_rows`
+    columns: see `lbutils.xlsxutils.iter_export_rows`
+    save: save the watermark after the last row, if False call `save()` of
+        the result once the exported file is built, so the rows are exported
+        again if building the file fails.
+    return: iterable of rows, `key` is the last key after the last row
+    raise: ValueError if name is invalid, when called instead of in the middle
+        of a streaming response.
+    """
+    _watermark_path(name)
+    return _DeltaRows(name, qs, field, func_data, columns, chunk_size, save)
+
+
+class _DeltaRows(object):
+
+    def __init__(self, name, qs, field, func_data, columns, chunk_size, save):
+        self.name = name
+        self.qs = qs
+        self.field = field
+        self.func_data = func_data
+        self.columns = columns
+        self.chunk_size = chunk_size or 2000
+        self.save_on_end = save
+        self.key = None
+        self.done = False
+
+    def __iter__(self):
+        rows = iter_keyset(self.qs, self.field, get_export_watermark(self.name), self.chunk_size, self.columns)
+        for self.key, row in rows:
+            yield self.func_data(row) if self.func_data else row
+        self.done = True
+        if self.save_on_end:
+            self.save()
+
+    def save(self):
+        """ save the last key as the watermark if every row is iterated """
+        if self.done and self.key is not None:
+            set_export_watermark(self.name, self.key)
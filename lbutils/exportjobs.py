@@ -0,0 +1,295 @@
+import base64
+import json
+import logging
+import os
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.db import connections
+from django.http import Http404
+from django.utils.crypto import constant_time_compare
+
+from .exportcache import get_export_root
+from .qs import dump_queryset, load_queryset
+from .utils import as_callable
+from .views import render_json
+from .xlsxutils import export_file, iter_export_rows, xlsw_write_sheet
+
+try:
+    import xlsxwriter as xlwt
+except ImportError:
+    pass
+
+
+__all__ = (
+    'enqueue_export', 'get_export_job', 'run_export_job', 'recover_export_jobs',
+    'cleanup_export_jobs', 'run_export_jobs', 'export_job_status', 'export_job_download',
+)
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+# fields of a job which are signed, the query is unpickled and func_data is imported by the worker
+SIGNED_FIELDS = ('id', 'filename', 'titles', 'query', 'func_data', 'columns', 'chunk_size')
+
+
+def _job_path(job_id, ext='json'):
+    if not JOB_ID_RE.match(job_id or ''):
+        raise ValueError('invalid export job id: %r' % job_id)
+    return os.path.join(get_export_root(), '%s.%s' % (job_id, ext))
+
+
+def _save_job(job):
+    path = _job_path(job['id'])
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(job, f)
+    os.replace(tmp_path, path)
+    return job
+
+
+def _job_signature(job):
+    value = json.dumps([job[k] for k in SIGNED_FIELDS], sort_keys=True)
+    return signing.Signer(salt='lbutils.exportjobs').signature(value)
+
+
+def _check_job_signature(job):
+    if not constant_time_compare(job.get('signature') or '', _job_signature(job)):
+        raise signing.BadSignature('export job %s has a bad signature' % job['id'])
+
+
+def get_export_job(job_id):
+    """ get export job by id, return None if not exist """
+    try:
+        with open(_job_path(job_id)) as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return None
+
+
+def enqueue_export(filename, titles, qs, func_data=None, columns=None, chunk_size=2000):
+    """
+    enqueue an xlsx export, the file is built by the `runexportjobs` command.
+
+    filename: file name
+    titles: title for this table
+    qs: queryset to export, the query is pickled into the job
+    func_data: path of a function to format object to list. ex: "app.exports.book_row"
+    columns: see `iter_export_rows`
+    chunk_size: see `iter_export_rows`
+    return: job id
+    """
+    if func_data is not None:
+        if not isinstance(func_data, str):
+            raise TypeError('func_data must be the path of a function')
+        as_callable(func_data)
+    job = {
+        'id': uuid.uuid4().hex,
+        'status': JOB_PENDING,
+        'filename': filename,
+        'titles': list(titles),
+        'query': base64.b64encode(dump_queryset(qs)).decode('ascii'),
+        'func_data': func_data,
+        'columns': columns,
+        'chunk_size': chunk_size,
+        'created': time.time(),
+        'finished': None,
+        'error': '',
+        'attempts': 0,
+    }
+    job['signature'] = _job_signature(job)
+    _save_job(job)
+    return job['id']
+
+
+def _claim_job(job_id):
+    try:
+        fd = os.open(_job_path(job_id, 'lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    os.close(fd)
+    job = get_export_job(job_id)
+    if not job or job['status'] != JOB_PENDING:
+        return None
+    job['status'] = JOB_RUNNING
+    job['attempts'] = job.get('attempts', 0) + 1
+    return _save_job(job)
+
+
+def _heartbeat(rows, lock_path, interval=60):
+    """ touch the lock file while rows are written, so a running job is not taken as stale """
+    last = time.time()
+    for row in rows:
+        now = time.time()
+        if now - last >= interval:
+            os.utime(lock_path)
+            last = now
+        yield row
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def recover_export_jobs(timeout=None, max_attempts=None):
+    """
+    recover the jobs of dead workers, a running job is dead if its lock file
+    is not touched in timeout seconds. It is pending again, or failed after max_attempts.
+
+    timeout: settings.LBUTILS_EXPORT_JOB_TIMEOUT, default is 600
+    max_attempts: settings.LBUTILS_EXPORT_JOB_ATTEMPTS, default is 3
+    return: recovered jobs
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'LBUTILS_EXPORT_JOB_TIMEOUT', 600)
+    if max_attempts is None:
+        max_attempts = getattr(settings, 'LBUTILS_EXPORT_JOB_ATTEMPTS', 3)
+    jobs = []
+    for job_id in _job_ids():
+        lock_path = _job_path(job_id, 'lock')
+        try:
+            if os.path.getmtime(lock_path) + timeout > time.time():
+                continue
+        except OSError:
+            continue
+        job = get_export_job(job_id)
+        if not job or job['status'] != JOB_RUNNING:
+            continue
+        logger.warning('export job %s is stale, attempts: %s', job_id, job.get('attempts'))
+        if job.get('attempts', 0) >= max_attempts:
+            job['status'] = JOB_FAILED
+            job['error'] = 'worker died'
+            job['finished'] = time.time()
+        else:
+            job['status'] = JOB_PENDING
+        _remove(_job_path(job_id, 'xlsx.tmp'))
+        _save_job(job)
+        if job['status'] == JOB_PENDING:
+            _remove(lock_path)
+        jobs.append(job)
+    return jobs
+
+
+def cleanup_export_jobs(max_age=None):
+    """
+    remove the files of the jobs finished max_age seconds ago.
+
+    max_age: settings.LBUTILS_EXPORT_JOB_RETENTION, default is 7 days
+    return: ids of removed jobs
+    """
+    if max_age is None:
+        max_age = getattr(settings, 'LBUTILS_EXPORT_JOB_RETENTION', 7 * 24 * 3600)
+    job_ids = []
+    for job_id in _job_ids():
+        job = get_export_job(job_id)
+        if not job or job['status'] not in (JOB_DONE, JOB_FAILED):
+            continue
+        if (job['finished'] or 0) + max_age > time.time():
+            continue
+        for ext in ('xlsx', 'xlsx.tmp', 'lock', 'json'):
+            _remove(_job_path(job_id, ext))
+        job_ids.append(job_id)
+    return job_ids
+
+
+def run_export_job(job_id):
+    """
+    build the file of a pending export job.
+
+    return: the job, None if the job is not pending or taken by another worker.
+    """
+    job = _claim_job(job_id)
+    if not job:
+        return None
+    path = _job_path(job_id, 'xlsx')
+    tmp_path = '%s.tmp' % path
+    try:
+        _check_job_signature(job)
+        func_data = as_callable(job['func_data']) if job['func_data'] else None
+        qs = load_queryset(base64.b64decode(job['query']))
+        rows = iter_export_rows(qs, func_data, job['columns'], job['chunk_size'])
+        rows = _heartbeat(rows, _job_path(job_id, 'lock'))
+        wb = xlwt.Workbook(tmp_path, {'constant_memory': True})
+        xlsw_write_sheet(wb, job['filename'], job['titles'], rows)
+        wb.close()
+        os.replace(tmp_path, path)
+        job['status'] = JOB_DONE
+    except Exception as e:
+        logger.exception('export job %s failed', job_id)
+        _remove(tmp_path)
+        job['status'] = JOB_FAILED
+        job['error'] = '%s' % e
+    job['finished'] = time.time()
+    return _save_job(job)
+
+
+def _job_ids():
+    job_ids = []
+    for fn in os.listdir(get_export_root()):
+        job_id, ext = os.path.splitext(fn)
+        if ext == '.json' and JOB_ID_RE.match(job_id):
+            job_ids.append(job_id)
+    return job_ids
+
+
+def _pending_job_ids():
+    job_ids = [e for e in _job_ids() if not os.path.exists(_job_path(e, 'lock'))]
+    return sorted(job_ids, key=lambda e: os.path.getmtime(_job_path(e)))
+
+
+def run_export_jobs(executor=None):
+    """
+    run all pending export jobs, after the jobs of dead workers are recovered
+    and the files of old jobs are removed, see `recover_export_jobs` and
+    `cleanup_export_jobs`.
+
+    executor: a `concurrent.futures` executor, jobs run in this process if None.
+        ex: `ProcessPoolExecutor(4, initializer=init_export_worker)`
+    return: finished jobs
+    """
+    recover_export_jobs()
+    cleanup_export_jobs()
+    job_ids = _pending_job_ids()
+    if executor is None:
+        jobs = [run_export_job(e) for e in job_ids]
+    else:
+        connections.close_all()
+        jobs = list(executor.map(run_export_job, job_ids))
+    return [e for e in jobs if e]
+
+
+def export_job_status(request, job_id):
+    """
+    view: status of an export job as json.
+
+    Permissions are not checked, wrap this view as needed.
+    """
+    job = get_export_job(job_id)
+    if not job:
+        raise Http404
+    data = {k: job[k] for k in ('id', 'status', 'filename', 'created', 'finished', 'error')}
+    return render_json(data, request=request)
+
+
+def export_job_download(request, job_id):
+    """
+    view: download the file of a finished export job.
+
+    Permissions are not checked, wrap this view as needed.
+    """
+    job = get_export_job(job_id)
+    if not job or job['status'] != JOB_DONE:
+        raise Http404
+    return export_file(open(_job_path(job_id, 'xlsx'), 'rb'), '%s.xlsx' % job['filename'])
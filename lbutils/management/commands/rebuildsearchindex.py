@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from lbutils import search_indexes
+
+
+class Command(BaseCommand):
+    help = "Build or rebuild the search indexes"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'models', nargs='*',
+            help='app_label.ModelName of the indexes to rebuild, default is all')
+
+    def handle(self, *args, **options):
+        labels = {e.lower() for e in options['models']}
+        models = [e for e in search_indexes if not labels or e._meta.label_lower in labels]
+        if labels and len(models) != len(labels):
+            raise CommandError('search index not registered: %s' % ', '.join(
+                labels - {e._meta.label_lower for e in models}))
+        for model in models:
+            fields, backend = search_indexes[model]
+            backend.build_index(model, fields)
+            self.stdout.write('%s rebuilt' % model._meta.label)
@@ -0,0 +1,35 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from lbutils import init_export_worker, run_export_jobs
+
+
+class Command(BaseCommand):
+    help = "Run pending export jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=None,
+            help='number of worker processes, 0 to run jobs in this process')
+        parser.add_argument(
+            '--interval', type=float, default=5,
+            help='seconds to wait between polls')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='run pending jobs and exit')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        if processes == 0:
+            return self.run(None, options)
+        with ProcessPoolExecutor(processes, initializer=init_export_worker) as executor:
+            self.run(executor, options)
+
+    def run(self, executor, options):
+        while True:
+            for job in run_export_jobs(executor):
+                self.stdout.write('%s %s' % (job['id'], job['status']))
+            if options['once']:
+                return
+            time.sleep(options['interval'])
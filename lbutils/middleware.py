@@ -0,0 +1,34 @@
+from .qs import identity_map
+from .routing import primary_pin_scope
+
+__all__ = (
+    'IdentityMapMiddleware', 'ReadReplicaMiddleware',
+)
+
+
+class IdentityMapMiddleware(object):
+    """
+    use `lbutils.qs.identity_map` in each request, so repeated
+    `get_or_none` calls for the same key query the database once.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with identity_map():
+            return self.get_response(request)
+
+
+class ReadReplicaMiddleware(object):
+    """
+    run each request in a `lbutils.routing.primary_pin_scope`,
+    reads go to settings.LBUTILS_READ_DB until the request writes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with primary_pin_scope():
+            return self.get_response(request)
@@ -0,0 +1,125 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+__all__ = (
+    'KeysetPaginator', 'KeysetPage',
+)
+
+
+class KeysetPage(object):
+    """
+    a page of `KeysetPaginator`, like `django.core.paginator.Page`.
+
+    next_cursor/previous_cursor: cursor of the next/previous page, None if no page.
+    """
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator(object):
+    """
+    paginate qs by opaque cursors instead of OFFSET, each page is one
+    range query after/before the key of the last/first object of a page,
+    so deep pages are as fast as the first one if the ordering is indexed.
+
+    ex: `page = KeysetPaginator(do_filter(qs, request.GET), 20).page(request.GET.get('cursor'))`
+    qs: queryset
+    per_page: objects per page
+    ordering: field names of qs.model, ex: `['-created', 'name']`, default is
+        the ordering of qs or model, pk is added as the tiebreaker.
+        The fields should not be null.
+    """
+
+    def __init__(self, qs, per_page, ordering=None):
+        self.qs = qs
+        self.per_page = int(per_page)
+        ordering = list(ordering or qs.query.order_by or qs.model._meta.ordering)
+        opts = qs.model._meta
+        self.fields = []
+        for e in ordering:
+            if not isinstance(e, str) or e == '?':
+                raise ValueError('keyset ordering must be field names: %r' % e)
+            desc, name = e.startswith('-'), e.lstrip('-')
+            field = opts.pk if name == 'pk' else opts.get_field(name)
+            self.fields.append((field, desc))
+        if not any(f.primary_key for f, desc in self.fields):
+            self.fields.append((opts.pk, False))
+
+    def _order_by(self, reverse=False):
+        # attname: a foreign key is ordered by its column, not the ordering of the related model
+        return ['%s%s' % ('-' if desc != reverse else '', f.attname) for f, desc in self.fields]
+
+    def _after(self, key, reverse=False):
+        q = Q()
+        for idx, (f, desc) in enumerate(self.fields):
+            kwargs = {e.attname: key[i] for i, (e, d) in enumerate(self.fields[:idx])}
+            kwargs['%s__%s' % (f.attname, 'lt' if desc != reverse else 'gt')] = key[idx]
+            q = q | Q(**kwargs)
+        return q
+
+    def _key(self, obj):
+        return [getattr(obj, f.attname) for f, desc in self.fields]
+
+    def encode_cursor(self, key, previous=False):
+        # full isoformat, DjangoJSONEncoder drops the microseconds of datetimes
+        key = [e.isoformat() if hasattr(e, 'isoformat') else e for e in key]
+        data = {'k': key, 'p': previous}
+        raw = json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':'))
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """ return (key, previous) of cursor, raise InvalidPage if it is invalid """
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            data = json.loads(raw.decode('utf-8'))
+            values = data['k']
+            if len(values) != len(self.fields):
+                raise ValueError
+            key = [f.to_python(v) for (f, desc), v in zip(self.fields, values)]
+            return key, bool(data['p'])
+        except (binascii.Error, ValueError, TypeError, KeyError, ValidationError):
+            raise InvalidPage('Invalid cursor')
+
+    def page(self, cursor=None):
+        """ get the page of cursor, the first page if cursor is empty """
+        previous = False
+        qs = self.qs.order_by(*self._order_by())
+        if cursor:
+            key, previous = self.decode_cursor(cursor)
+            qs = self.qs.order_by(*self._order_by(previous)).filter(self._after(key, previous))
+        object_list = list(qs[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if previous:
+            object_list.reverse()
+        if not object_list:
+            return KeysetPage(object_list, None, None)
+        has_next = has_more if not previous else True
+        has_previous = has_more if previous else bool(cursor)
+        next_cursor = self.encode_cursor(self._key(object_list[-1])) if has_next else None
+        previous_cursor = self.encode_cursor(self._key(object_list[0]), True) if has_previous else None
+        return KeysetPage(object_list, next_cursor, previous_cursor)
@@ -0,0 +1,129 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+__all__ = (
+    'FilterPlanner',
+)
+
+logger = logging.getLogger(__name__)
+
+# lookups which a B-tree index can be used for
+INDEXED_LOOKUPS = ('exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range', 'isnull', 'startswith')
+
+
+class FilterPlanner(object):
+    """
+    check the lookups of `do_filter` against the indexes of the model,
+    and log slow queries, ex:
+
+        planner = FilterPlanner()
+        qs = do_filter(qs, request.GET, planner=planner)
+        with planner.timed(qs):
+            rows = list(qs)
+
+    mode: 'warn' logs lookups which can not use an index,
+        'reject' ignores them like invalid lookups(raise FieldError in strict mode)
+    slow_ms: milliseconds, settings.LBUTILS_SLOW_FILTER_MS, default is 500
+    explain: log the EXPLAIN output of slow queries
+    """
+
+    def __init__(self, mode='warn', slow_ms=None, explain=True):
+        if mode not in ('warn', 'reject'):
+            raise ValueError('invalid planner mode: %s' % mode)
+        self.mode = mode
+        if slow_ms is None:
+            slow_ms = getattr(settings, 'LBUTILS_SLOW_FILTER_MS', 500)
+        self.slow_ms = slow_ms
+        self.explain = explain
+        self.keys = []
+        self._indexed = {}
+        self._explaining = False
+
+    def indexed_fields(self, model):
+        """ names of the fields of model which are the first column of an index """
+        if model not in self._indexed:
+            opts = model._meta
+            names = {f.name for f in opts.concrete_fields if f.primary_key or f.unique or f.db_index}
+            for index in opts.indexes:
+                if index.fields:
+                    names.add(index.fields[0].lstrip('-'))
+            # index_together is removed in Django 5.1
+            for fields in list(getattr(opts, 'index_together', ())) + list(opts.unique_together):
+                names.add(fields[0])
+            for constraint in getattr(opts, 'constraints', []):
+                if getattr(constraint, 'fields', None):
+                    names.add(constraint.fields[0])
+            self._indexed[model] = names
+        return self._indexed[model]
+
+    def can_use_index(self, field, lookup_name):
+        model = getattr(field, 'model', None)
+        if model is None or lookup_name not in INDEXED_LOOKUPS:
+            return False
+        return field.name in self.indexed_fields(model)
+
+    def plan(self, model, lookups, qdata):
+        """
+        check lookups of `compile_filter`.
+
+        return: (lookups to filter, errors of rejected lookups)
+        """
+        used, errors = [], []
+        for lookup in lookups:
+            qk, k, field, lookup_name = lookup
+            if qdata.get(qk) in ('', None) or self.can_use_index(field, lookup_name):
+                used.append(lookup)
+                continue
+            errors.append((qk, 'lookup can not use an index: %s' % k))
+            if self.mode == 'warn':
+                used.append(lookup)
+        if errors and self.mode == 'warn':
+            logger.warning('%s lookups can not use an index: %s', model._meta.label, [e[0] for e in errors])
+        self.keys = [e[0] for e in used if qdata.get(e[0]) not in ('', None)]
+        return used, errors if self.mode == 'reject' else []
+
+    def _log_slow(self, connection, sql, params, elapsed):
+        plan = ''
+        if self.explain and not self._explaining:
+            self._explaining = True
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute('%s %s' % (connection.ops.explain_query_prefix(), sql), params)
+                    plan = '\n'.join(' '.join('%s' % e for e in row) for row in cursor.fetchall())
+            except DatabaseError as e:
+                plan = 'EXPLAIN failed: %s' % e
+            finally:
+                self._explaining = False
+        logger.warning(
+            'slow filter %.0fms, keys: %s\nsql: %s\nparams: %s\n%s',
+            elapsed * 1000, self.keys, sql, params, plan)
+
+    @contextmanager
+    def timed(self, qs=None, using=None):
+        """
+        log queries of the block which take more than slow_ms
+
+        qs: queryset to time, its database(`qs.db`) is wrapped,
+            ex: the read replica of `lbutils.routing.read_qs`
+        using: database alias, default is the database of qs or 'default'
+        """
+        if using is None:
+            using = qs.db if qs is not None else DEFAULT_DB_ALIAS
+        connection = connections[using]
+
+        def wrapper(execute, sql, params, many, context):
+            if self._explaining:
+                return execute(sql, params, many, context)
+            start = time.monotonic()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                elapsed = time.monotonic() - start
+                if elapsed * 1000 >= self.slow_ms and not many:
+                    self._log_slow(connection, sql, params, elapsed)
+        with connection.execute_wrapper(wrapper):
+            yield self
@@ -1,109 +1,911 @@
-from django.db.models import F, Max, Q, Sum
+import hashlib
+import json
+import logging
+import math
+import pickle
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import lru_cache
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, FieldError, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router
+from django.db.models import (
+    Avg, CharField, Count, F, Max, Min, Q, Sum, TextField, Value,
+)
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+
+from .cacheutils import get_lbutils_cache, get_model_version, get_qs_cache_key
+from .routing import read_qs
+from .search import get_search_index
+from .utils import fmt_num
+
+try:
+    from asgiref.local import Local
+    from asgiref.sync import sync_to_async
+except ImportError:  # Django < 3.0, the ORM does not check the async context
+    Local = threading.local
+
+    def sync_to_async(func):
+        async def wrapper(*args, **kwargs):
+            return func(*args, **kwargs)
+        return wrapper
 
 __all__ = (
-    'get_or_none', 'get_pk_or_none', 'get_sum',
-    'get_max', 'do_filter',
+    'get_or_none', 'get_pk_or_none', 'get_many_or_none', 'identity_map',
+    'register_cached_lookup', 'unregister_cached_lookup', 'cached_lookups', 'get_sum',
+    'get_max', 'get_aggregates', 'do_filter', 'dump_queryset', 'load_queryset',
+    'detect_related', 'auto_related', 'iter_keyset', 'resolve_lookup',
+    'compile_filter', 'in_list_q', 'FilteredCount', 'estimate_count',
+    'estimate_table_rows', 'count_filtered', 'aget_or_none', 'aget_pk_or_none',
+    'aget_aggregates', 'aget_sum', 'aget_max', 'acount_filtered',
 )
 
+logger = logging.getLogger(__name__)
+
+
+_local = Local()
+_MISSING = object()
+cached_lookups = {}
+
+
+@contextmanager
+def identity_map():
+    """
+    objects got by `get_or_none`/`get_many_or_none` in this block are
+    remembered, getting them again does not query the database.
+
+    The objects of a model are forgotten when a object of the model is
+    saved or deleted. See `lbutils.middleware.IdentityMapMiddleware`.
+    """
+    objects = getattr(_local, 'objects', None)
+    _local.objects = {} if objects is None else objects
+    try:
+        yield
+    finally:
+        _local.objects = objects
+
+
+def _lookup_key(model_class, kwargs):
+    """ normalized key of the lookup kwargs, None if it can not be a key """
+    items = []
+    opts = model_class._meta
+    for k, v in kwargs.items():
+        try:
+            field = opts.pk if k in ('pk', opts.pk.attname) else opts.get_field(k)
+            if field.concrete and not field.many_to_many:
+                k, v = field.attname, field.to_python(v)
+            hash(v)
+        except (FieldDoesNotExist, ValidationError, TypeError):
+            return None
+        items.append((k, v))
+    return (model_class, tuple(sorted(items, key=lambda e: e[0])))
+
+
+def _identity_get(key):
+    objects = getattr(_local, 'objects', None)
+    if objects is None or key is None:
+        return _MISSING
+    return objects.get(key, _MISSING)
+
+
+def _identity_set(key, obj):
+    objects = getattr(_local, 'objects', None)
+    if objects is not None and key is not None:
+        objects[key] = obj
+
+
+def _identity_clear(sender, **kwargs):
+    objects = getattr(_local, 'objects', None)
+    if objects:
+        for key in [e for e in objects if e[0] is sender]:
+            del objects[key]
+
+
+post_save.connect(_identity_clear, dispatch_uid='lbutils:identity_map')
+post_delete.connect(_identity_clear, dispatch_uid='lbutils:identity_map')
+
+
+def register_cached_lookup(model, timeout=300, negative_timeout=30):
+    """
+    cache the objects got by `get_or_none` of model in `get_lbutils_cache()`,
+    for small and hot models, ex: categories and config rows.
+
+    The cache is invalidated when model is saved or deleted, see
+    `lbutils.cacheutils.get_model_version`.
+    timeout: seconds to cache a found object
+    negative_timeout: seconds to cache a lookup which found nothing
+    """
+    cached_lookups[model] = (timeout, negative_timeout)
+
+
+def unregister_cached_lookup(model):
+    cached_lookups.pop(model, None)
+
+
+def _cache_get_or_none(model_class, key, kwargs):
+    timeout, negative_timeout = cached_lookups[model_class]
+    cache = get_lbutils_cache()
+    raw = repr((get_model_version(model_class), key[1]))
+    cache_key = 'lbutils:lookup:%s:%s' % (
+        model_class._meta.label_lower, hashlib.sha1(raw.encode('utf-8')).hexdigest())
+    value = cache.get(cache_key)
+    if value is not None:
+        return value[0]
+    try:
+        obj = model_class.objects.get(**kwargs)
+    except Exception:
+        obj = None
+    cache.set(cache_key, [obj], timeout if obj else negative_timeout)
+    return obj
+
 
 def get_or_none(model_class, *args, **kwargs):
+    key = None if args else _lookup_key(model_class, kwargs)
+    obj = _identity_get(key)
+    if obj is not _MISSING:
+        return obj
+    if key is not None and model_class in cached_lookups:
+        obj = _cache_get_or_none(model_class, key, kwargs)
+    else:
+        try:
+            obj = model_class.objects.get(*args, **kwargs)
+        except Exception:
+            obj = None
+    _identity_set(key, obj)
+    return obj
+
+
+def get_pk_or_none(model_class, *args, **kwargs):
+    if model_class in cached_lookups:
+        obj = get_or_none(model_class, *args, **kwargs)
+        return obj.pk if obj else None
+    obj = _identity_get(None if args else _lookup_key(model_class, kwargs))
+    if obj is not _MISSING:
+        return obj.pk if obj else None
     try:
-        return model_class.objects.get(*args, **kwargs)
+        return model_class.objects.values_list('pk', flat=True).get(*args, **kwargs)
     except Exception:
         return None
 
 
-def get_pk_or_none(model_class, *args, **kwargs):
-    obj = get_or_none(model_class, *args, **kwargs)
-    return obj.pk if obj else None
+def get_many_or_none(model_class, keys, field='pk'):
+    """
+    get objects by many values of a field in one query.
+
+    model_class: model
+    keys: values of field
+    field: a unique field name
+    return: `{key: object}`, object is None if not found or the key is invalid.
+    """
+    opts = model_class._meta
+    f = opts.pk if field == 'pk' else opts.get_field(field)
+    result, values, valid_keys = {}, set(), {}
+    for k in keys:
+        try:
+            valid_keys[k] = f.to_python(k)
+        except (ValidationError, TypeError):
+            result[k] = None
+    keys = valid_keys
+    for k, v in keys.items():
+        obj = _identity_get(_lookup_key(model_class, {f.attname: v}))
+        if obj is _MISSING:
+            values.add(v)
+        else:
+            result[k] = obj
+    objects = {}
+    if values:
+        lookup = '%s__in' % f.name
+        if len(values) > getattr(settings, 'LBUTILS_IN_LIST_THRESHOLD', 500):
+            q = in_list_q(lookup, f, list(values), router.db_for_read(model_class))
+        else:
+            q = Q(**{lookup: values})
+        for obj in model_class.objects.filter(q):
+            v = getattr(obj, f.attname)
+            objects[v] = None if v in objects else obj
+        for v in values:
+            _identity_set(_lookup_key(model_class, {f.attname: v}), objects.get(v))
+    for k, v in keys.items():
+        if k not in result:
+            result[k] = objects.get(v)
+    return result
 
 
-def get_sum(qs, field):
+def get_sum(qs, field, cache_timeout=None, using=None):
     """
     get sum for queryset.
 
     ``qs``: queryset
     ``field``: The field name to sum.
+    ``cache_timeout``: see `get_aggregates`
+    ``using``: see `get_aggregates`
     """
-    sum_field = '%s__sum' % field
-    qty = qs.aggregate(Sum(field))[sum_field]
-    return qty if qty else 0
+    return get_aggregates(qs, sum=[field], cache_timeout=cache_timeout, using=using)['%s__sum' % field]
 
 
-def get_max(qs, field):
+def get_max(qs, field, cache_timeout=None, using=None):
     """
     get max for queryset.
 
     qs: queryset
     field: The field name to max.
+    cache_timeout: see `get_aggregates`
+    using: see `get_aggregates`
+    """
+    return get_aggregates(qs, max=[field], cache_timeout=cache_timeout, using=using)['%s__max' % field]
+
+
+AGGREGATES = (('sum', Sum), ('max', Max), ('min', Min), ('avg', Avg))
+
+
+def _aggregate_exprs(funcs, count):
+    aggregates = {}
+    for name, func in AGGREGATES:
+        for field in funcs[name] or []:
+            aggregates['%s__%s' % (field, name)] = func(field)
+    if count is True:
+        aggregates['count'] = Count('pk')
+    elif count:
+        aggregates['%s__count' % count] = Count(count)
+    return aggregates
+
+
+def _fmt_aggregates(aggregates, row):
+    return {k: row[k] if row[k] else 0 for k in aggregates}
+
+
+def get_aggregates(qs, sum=None, max=None, min=None, avg=None, count=None, group_by=None,
+                   cache_timeout=None, using=None):
+    """
+    get aggregates for queryset in one query, null is 0.
+
+    ex: `get_aggregates(qs, sum=['price'], max=['price'], count=True)`
+    return `{'price__sum': 300, 'price__max': 200, 'count': 3}`
+    qs: queryset
+    sum/max/min/avg: field names
+    count: True to count rows, or a field name to count its values(key is `<field>__count`)
+    group_by: a field name or a list of field names, return
+        `{value: aggregates}` ordered by group_by, value is a tuple for a list.
+    cache_timeout: seconds to cache the result in `get_lbutils_cache()`, not cached if None.
+        The cache key changes when the data of the models used by qs changes,
+        see `lbutils.cacheutils.get_qs_cache_key`.
+    using: database alias to read, default is settings.LBUTILS_READ_DB, see `lbutils.routing.read_qs`
+    """
+    funcs = {'sum': sum, 'max': max, 'min': min, 'avg': avg}
+    qs = read_qs(qs, using)
+    if cache_timeout is not None:
+        cache = get_lbutils_cache()
+        key = get_qs_cache_key('aggregates', qs, funcs, count, group_by)
+        result = cache.get(key)
+        if result is None:
+            result = get_aggregates(qs, sum, max, min, avg, count, group_by)
+            cache.set(key, result, cache_timeout)
+        return result
+    aggregates = _aggregate_exprs(funcs, count)
+    if group_by is None:
+        return _fmt_aggregates(aggregates, qs.aggregate(**aggregates))
+    fields = [group_by] if isinstance(group_by, str) else list(group_by)
+    rows = qs.order_by().values(*fields).annotate(**aggregates).order_by(*fields)
+    result = {}
+    for row in rows:
+        key = row[group_by] if isinstance(group_by, str) else tuple(row[e] for e in fields)
+        result[key] = _fmt_aggregates(aggregates, row)
+    return result
+
+
+class FilteredCount(int):
+    """
+    result of `count_filtered`, an int.
+
+    exact: False if the count is capped or estimated
+    display: text to show, ex: '9,000', '10,000+', '~12,000'
+    """
+
+    def __new__(cls, value, exact=True, display=None):
+        obj = super(FilteredCount, cls).__new__(cls, value)
+        obj.exact = exact
+        obj.display = display or fmt_num(value)
+        return obj
+
+
+def estimate_count(qs):
+    """ row count of qs estimated by the query planner, None if not supported """
+    connection = connections[qs.db]
+    if connection.vendor != 'postgresql':
+        return None
+    try:
+        sql, params = qs.query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def estimate_table_rows(model, using=None):
+    """ row count of the table of model from the database statistics, None if not supported """
+    connection = connections[using or router.db_for_read(model)]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = to_regclass(%s)', [model._meta.db_table])
+        row = cursor.fetchone()
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+def _capped_count(count, cap):
+    if count > cap:
+        return FilteredCount(cap, False, '%s+' % fmt_num(cap))
+    return FilteredCount(count)
+
+
+def count_filtered(qs, strategy='auto', cap=None, cache_timeout=None):
+    """
+    count qs for list pages.
+
+    qs: queryset, ex: the result of `do_filter`
+    strategy:
+        'exact': `qs.count()`
+        'cached': exact count cached for cache_timeout seconds, keyed by the sql of qs,
+            see `lbutils.cacheutils.get_qs_cache_key`
+        'estimate': estimated by the query planner(PostgreSQL), 'capped' if not supported
+        'capped': count at most cap + 1 rows, displayed as '10,000+' if more than cap
+        'auto': 'exact' if the table has not more than settings.LBUTILS_COUNT_EXACT_ROWS
+            rows(default is 100000), else 'capped' and the planner estimate if more than cap.
+            'capped' if the table size is unknown.
+    cap: settings.LBUTILS_COUNT_CAP, default is 10000
+    cache_timeout: settings.LBUTILS_COUNT_CACHE_TIMEOUT, default is 60
+    return: `FilteredCount`
+    """
+    if cap is None:
+        cap = getattr(settings, 'LBUTILS_COUNT_CAP', 10000)
+    if strategy == 'auto':
+        rows = estimate_table_rows(qs.model, qs.db)
+        if rows is not None and rows <= getattr(settings, 'LBUTILS_COUNT_EXACT_ROWS', 100000):
+            return FilteredCount(qs.count())
+        count = count_filtered(qs, 'capped', cap)
+        if count.exact:
+            return count
+        estimate = estimate_count(qs)
+        if estimate is not None and estimate > cap:
+            return FilteredCount(estimate, False, '~%s' % fmt_num(estimate))
+        return count
+    if strategy == 'exact':
+        return FilteredCount(qs.count())
+    if strategy == 'cached':
+        if cache_timeout is None:
+            cache_timeout = getattr(settings, 'LBUTILS_COUNT_CACHE_TIMEOUT', 60)
+        cache = get_lbutils_cache()
+        key = get_qs_cache_key('count', qs)
+        count = cache.get(key)
+        if count is None:
+            count = qs.count()
+            cache.set(key, count, cache_timeout)
+        return FilteredCount(count)
+    if strategy == 'estimate':
+        estimate = estimate_count(qs)
+        if estimate is not None:
+            return FilteredCount(estimate, False, '~%s' % fmt_num(estimate))
+        strategy = 'capped'
+    if strategy == 'capped':
+        return _capped_count(qs.order_by()[:cap + 1].count(), cap)
+    raise ValueError('invalid count strategy: %s' % strategy)
+
+
+def _native_get(model_class):
+    # the identity map and the lookup cache are sync
+    return hasattr(model_class.objects, 'aget') and model_class not in cached_lookups \
+        and getattr(_local, 'objects', None) is None
+
+
+async def aget_or_none(model_class, *args, **kwargs):
+    """ async `get_or_none`, uses the async ORM API if Django supports it """
+    if not _native_get(model_class):
+        return await sync_to_async(get_or_none)(model_class, *args, **kwargs)
+    try:
+        return await model_class.objects.aget(*args, **kwargs)
+    except Exception:
+        return None
+
+
+async def aget_pk_or_none(model_class, *args, **kwargs):
+    """ async `get_pk_or_none` """
+    if not _native_get(model_class):
+        return await sync_to_async(get_pk_or_none)(model_class, *args, **kwargs)
+    try:
+        return await model_class.objects.values_list('pk', flat=True).aget(*args, **kwargs)
+    except Exception:
+        return None
+
+
+async def aget_aggregates(qs, sum=None, max=None, min=None, avg=None, count=None, group_by=None,
+                          cache_timeout=None, using=None):
+    """ async `get_aggregates` """
+    if not hasattr(qs, 'aaggregate') or group_by is not None or cache_timeout is not None:
+        return await sync_to_async(get_aggregates)(qs, sum, max, min, avg, count, group_by, cache_timeout, using)
+    qs = read_qs(qs, using)
+    aggregates = _aggregate_exprs({'sum': sum, 'max': max, 'min': min, 'avg': avg}, count)
+    return _fmt_aggregates(aggregates, await qs.aaggregate(**aggregates))
+
+
+async def aget_sum(qs, field, cache_timeout=None, using=None):
+    """ async `get_sum` """
+    result = await aget_aggregates(qs, sum=[field], cache_timeout=cache_timeout, using=using)
+    return result['%s__sum' % field]
+
+
+async def aget_max(qs, field, cache_timeout=None, using=None):
+    """ async `get_max` """
+    result = await aget_aggregates(qs, max=[field], cache_timeout=cache_timeout, using=using)
+    return result['%s__max' % field]
+
+
+async def acount_filtered(qs, strategy='auto', cap=None, cache_timeout=None):
+    """
+    async `count_filtered`, 'exact' and 'capped' use `acount` if Django supports it,
+    so does 'auto' if the database has no table statistics(not PostgreSQL).
+    """
+    if strategy == 'auto' and connections[qs.db].vendor != 'postgresql':
+        strategy = 'capped'
+    if not hasattr(qs, 'acount') or strategy not in ('exact', 'capped'):
+        return await sync_to_async(count_filtered)(qs, strategy, cap, cache_timeout)
+    if strategy == 'exact':
+        return FilteredCount(await qs.acount())
+    if cap is None:
+        cap = getattr(settings, 'LBUTILS_COUNT_CAP', 10000)
+    return _capped_count(await qs.order_by()[:cap + 1].acount(), cap)
+
+
+def dump_queryset(qs):
+    """
+    dump queryset to bytes, so it can be sent to other processes.
+    """
+    prefetch_related = qs._prefetch_related_lookups
+    return pickle.dumps((qs.model._meta.label, qs.db, qs.query, prefetch_related))
+
+
+def load_queryset(data):
+    """
+    load queryset dumped by `dump_queryset`.
+    """
+    label, using, query, prefetch_related = pickle.loads(data)
+    qs = apps.get_model(label)._default_manager.using(using).all()
+    qs.query = query
+    return qs.prefetch_related(*prefetch_related)
+
+
+def _select_related_field(model, name):
+    """ if name is a relation `select_related` can follow: forward FK/one-to-one, reverse one-to-one """
+    try:
+        f = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    if f.concrete:
+        return f.is_relation and (f.many_to_one or f.one_to_one)
+    return f.one_to_one and f.auto_created  # not GenericForeignKey
+
+
+def _cached_relations(obj, prefix=''):
+    paths = []
+    for name, value in getattr(obj._state, 'fields_cache', {}).items():
+        if not _select_related_field(type(obj), name):
+            continue
+        path = prefix + name
+        sub_paths = _cached_relations(value, path + '__') if value is not None else []
+        paths.extend(sub_paths or [path])
+    return paths
+
+
+def _queried_relations(model, sqls, connection):
+    """
+    to-many relations of model whose related manager queries are in sqls,
+    matched by their filter on the column pointing to model, ex:
+    `"app_book"."category_id" = %s`, `"app_book_authors"."book_id" = %s`
+    """
+    qn = connection.ops.quote_name
+    paths = []
+    for f in model._meta.get_fields():
+        if f.many_to_many and f.concrete:
+            table, column = f.remote_field.through._meta.db_table, f.m2m_column_name()
+        elif f.many_to_many:
+            table, column = f.through._meta.db_table, f.field.m2m_reverse_name()
+        elif f.one_to_many:
+            table, column = f.related_model._meta.db_table, f.field.column
+        else:
+            continue
+        condition = '%s.%s = %%s' % (qn(table), qn(column))
+        if any(condition in sql for sql in sqls):
+            paths.append(f.name if f.concrete else f.get_accessor_name())
+    return paths
+
+
+def detect_related(qs, func_data, sample=5):
+    """
+    detect the relations accessed by func_data on the first rows of qs.
+
+    Forward relations are read from the related object cache of the rows
+    (nested ones included), to-many relations are found from the queries
+    run by func_data.
+    qs: queryset
+    func_data: a function to format object. ex: `lambda o: [o.pk, o.category.name]`
+    sample: number of rows to check
+    return: (select_related, prefetch_related) lists of field path
     """
-    max_field = '%s__max' % field
-    num = qs.aggregate(Max(field))[max_field]
-    return num if num else 0
+    select_related, sqls = [], []
 
+    def log_sql(execute, sql, params, many, context):
+        sqls.append(sql)
+        return execute(sql, params, many, context)
 
-def do_filter(qs, qdata, quick_query_fields=[], int_quick_query_fields=[]):
+    objs = list(qs[:sample])
+    with connections[qs.db].execute_wrapper(log_sql):
+        for o in objs:
+            func_data(o)
+    if not sqls:
+        return [], []
+    for o in objs:
+        select_related.extend(e for e in _cached_relations(o) if e not in select_related)
+    return select_related, _queried_relations(qs.model, sqls, connections[qs.db])
+
+
+def auto_related(qs, func_data, sample=5):
+    """
+    add select_related/prefetch_related to qs for the relations accessed by
+    func_data, see `detect_related`.
+
+    Prefetches are ignored by `qs.iterator()` before Django 4.1.
+    """
+    select_related, prefetch_related = detect_related(qs, func_data, sample)
+    if select_related or prefetch_related:
+        logger.info(
+            'auto related for %s: select_related=%s prefetch_related=%s',
+            qs.model._meta.label, select_related, prefetch_related)
+    if select_related:
+        qs = qs.select_related(*select_related)
+    if prefetch_related:
+        qs = qs.prefetch_related(*prefetch_related)
+    return qs
+
+
+def _keyset_after(field, key):
+    value, pk = key
+    if field == 'pk':
+        return Q(pk__gt=pk)
+    if value is None:  # nulls are ordered first
+        return Q(**{'%s__isnull' % field: False}) | Q(**{'%s__isnull' % field: True, 'pk__gt': pk})
+    return Q(**{'%s__gt' % field: value}) | Q(**{field: value, 'pk__gt': pk})
+
+
+def iter_keyset(qs, field='pk', start=None, chunk_size=2000, columns=None):
+    """
+    iterate qs ordered by (field, pk), each chunk is fetched by a range
+    query after the last key instead of OFFSET. nulls are ordered first.
+
+    qs: queryset
+    field: a concrete field of qs.model, ex: 'updated_at'
+    start: key (value of field, pk) to start after
+    chunk_size: rows per query
+    columns: fetch rows with `values_list(*columns)` instead of objects
+    yield: (key, row)
+    """
+    if field == 'pk':
+        qs, attname = qs.order_by('pk'), 'pk'
+    else:
+        qs = qs.order_by(F(field).asc(nulls_first=True), 'pk')
+        attname = qs.model._meta.get_field(field).attname
+    if columns:
+        qs = qs.values_list(*(list(columns) + [field, 'pk']))
+    key = start
+    while True:
+        chunk_qs = qs if key is None else qs.filter(_keyset_after(field, key))
+        rows = list(chunk_qs[:chunk_size])
+        for row in rows:
+            if columns:
+                key, row = tuple(row[-2:]), row[:-2]
+            else:
+                key = (getattr(row, attname), row.pk)
+            yield key, row
+        if len(rows) < chunk_size:
+            return
+
+
+def resolve_lookup(model, lookup, annotations=None):
+    """
+    resolve a filter lookup against model._meta.
+
+    lookup: ex: 'category__name__icontains'
+    annotations: `qs.query.annotations`, the lookup may start with an annotation name
+    return: (field, lookup name), the value of the lookup is compared with field.
+    raise: FieldError if lookup is invalid
+    """
+    opts, field = model._meta, None
+    parts = lookup.split(LOOKUP_SEP)
+    if annotations and parts[0] in annotations:
+        field = annotations[parts.pop(0)].output_field
+        opts = field.related_model._meta if field.is_relation and field.related_model else None
+    while parts and opts is not None:
+        name = opts.pk.name if parts[0] == 'pk' else parts[0]
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            if field is None:
+                raise FieldError("Cannot resolve keyword '%s' into field of %s" % (
+                    name, model._meta.label))
+            break
+        parts.pop(0)
+        opts = field.related_model._meta if field.is_relation and field.related_model else None
+    names = parts or ['exact']
+    for idx, name in enumerate(names):
+        if idx == len(names) - 1 and field.get_lookup(name):
+            return field, name
+        transform = field.get_transform(name)
+        if transform is None:
+            raise FieldError("Unsupported lookup '%s' for %s in '%s'" % (
+                name, field.__class__.__name__, lookup))
+        field = transform(Value(None, output_field=field)).output_field
+    return field, 'exact'
+
+
+QUICK_SEARCH_MODES = ('icontains', 'exact', 'iexact', 'istartswith', 'startswith', 'prefix')
+
+
+def _compile_quick_field(model, f):
+    """
+    return (lookup, field, lower) of a quick query field.
+
+    field: the field to check the type of the keyword, None if the field is not typed
+    """
+    if isinstance(f, str):
+        lookup = '%s__icontains' % f
+        resolve_lookup(model, lookup)
+        return lookup, None, False
+    name, mode = f
+    if mode not in QUICK_SEARCH_MODES:
+        raise FieldError('invalid quick search mode: %s' % mode)
+    lookup = '%s__%s' % (name, 'startswith' if mode == 'prefix' else mode)
+    field, lookup_name = resolve_lookup(model, lookup)
+    return lookup, field, mode == 'prefix'
+
+
+def _can_match(field, value):
+    """
+    if value can match a typed quick query field: not digits for text fields,
+    values accepted by `to_python` of others(the target field of relations).
+    """
+    field = _in_target_field(field)
+    if isinstance(field, (CharField, TextField)):
+        return not value.isdigit()
+    try:
+        value = field.to_python(value)
+    except (ValidationError, TypeError, ValueError):
+        return False
+    if isinstance(value, (float, Decimal)):
+        return math.isfinite(value)
+    return True
+
+
+@lru_cache(maxsize=512)
+def compile_filter(model, keys, quick_query_fields=(), int_quick_query_fields=(), annotations=frozenset()):
+    """
+    compile the params of `do_filter` for model, the result is cached.
+
+    keys: frozenset of the 'q__' keys in qdata
+    annotations: frozenset of the annotation names of the queryset, lookups of
+        annotations are resolved by `do_filter` for each queryset.
+    return: (lookups, quick lookups, int quick lookups, errors)
+        lookups: list of (key in qdata, lookup, field, lookup name),
+            field and lookup name are None for lookups of annotations
+        errors: list of (key, error message) for invalid lookups, key of
+            invalid quick query fields is 'q_quick_search_kw'
+    """
+    lookups, errors = [], []
+    for k in sorted(keys):
+        if k[3:].split(LOOKUP_SEP)[0] in annotations:
+            lookups.append((k, k[3:], None, None))
+            continue
+        try:
+            field, lookup_name = resolve_lookup(model, k[3:])
+        except FieldError as e:
+            errors.append((k, '%s' % e))
+            continue
+        lookups.append((k, k[3:], field, lookup_name))
+    quick_lookups, int_lookups = [], []
+    for f in quick_query_fields:
+        try:
+            quick_lookups.append(_compile_quick_field(model, f))
+        except FieldError as e:
+            errors.append(('q_quick_search_kw', '%s' % e))
+    for f in int_quick_query_fields:
+        try:
+            resolve_lookup(model, f)
+        except FieldError as e:
+            errors.append(('q_quick_search_kw', '%s' % e))
+            continue
+        int_lookups.append(f)
+    return lookups, quick_lookups, int_lookups, errors
+
+
+def _resolve_annotation_lookups(model, lookups, annotations):
+    result, errors = [], []
+    for qk, k, field, lookup_name in lookups:
+        if field is None:
+            try:
+                field, lookup_name = resolve_lookup(model, k, annotations)
+            except FieldError as e:
+                errors.append((qk, '%s' % e))
+                continue
+        result.append((qk, k, field, lookup_name))
+    return result, errors
+
+
+def do_filter(qs, qdata, quick_query_fields=[], int_quick_query_fields=[], strict=False, planner=None):
     """
     auto filter queryset by dict.
 
+    The lookups are resolved against the model once and cached, see `compile_filter`.
+    If a search index is registered for the model, the quick search keyword is
+    searched by its backend instead of `icontains` on quick_query_fields,
+    see `lbutils.search.register_search_index`.
+    Values of an `__in` lookup longer than settings.LBUTILS_IN_LIST_THRESHOLD(default is 500)
+    are filtered by `in_list_q`.
     qs: queryset need to filter.
     qdata:
-    quick_query_fields:
+    quick_query_fields: fields searched by the quick search keyword with `icontains`,
+        an item can be `(field, mode)` to use an index, mode is one of:
+        'exact', 'iexact', 'istartswith', 'startswith',
+        'prefix': `startswith` of the lowercase keyword, for a lowercase shadow column.
+        Fields with a mode are skipped if the keyword can not match their type:
+        text fields for digits, other fields(numbers, dates, relations, ...)
+        for keywords their `to_python` rejects. No row is found if every field is skipped.
     int_quick_query_fields:
+    strict: raise FieldError for invalid lookups and ValueError for invalid values,
+        they are logged and ignored if False.
+    planner: a `lbutils.planner.FilterPlanner` to check lookups against the indexes
     """
+    keys = frozenset(k for k in qdata.keys() if k.startswith('q__'))
+    annotations = qs.query.annotations
+    lookups, quick_lookups, int_lookups, errors = compile_filter(
+        qs.model, keys, tuple(quick_query_fields), tuple(int_quick_query_fields),
+        frozenset(annotations))
+    if annotations:
+        lookups, annotation_errors = _resolve_annotation_lookups(qs.model, lookups, annotations)
+        errors = errors + annotation_errors
+    if planner is not None:
+        lookups, rejected = planner.plan(qs.model, lookups, qdata)
+        errors = errors + rejected
+    if errors:
+        if strict:
+            raise FieldError(errors[0][1])
+        logger.warning('do_filter ignored invalid lookups: %s', errors)
+    keyword = qdata.get('q_quick_search_kw')
+    search_q = None
+    index = get_search_index(qs.model)
+    if index and keyword and quick_query_fields:
+        fields, backend = index
+        search_q = backend.get_q(qs.model, keyword, fields)
     try:
         qs = qs.filter(
-            __gen_quick_query_params(
-                qdata.get('q_quick_search_kw'), quick_query_fields,
-                int_quick_query_fields)
+            __gen_quick_query_params(keyword, quick_lookups, int_lookups, search_q)
         )
-        q, kw_query_params = __gen_query_params(qdata)
+    except (ValueError, TypeError, ValidationError, FieldError) as e:
+        if strict:
+            raise
+        logger.warning('do_filter ignored invalid quick search keyword: %s', e)
+    try:
+        q, kw_query_params = __gen_query_params(lookups, qdata, qs.db)
         qs = qs.filter(q, **kw_query_params)
-    except:
-        import traceback
-        traceback.print_exc()
+    except (ValueError, TypeError, ValidationError, FieldError) as e:
+        if strict:
+            raise
+        logger.warning('do_filter ignored invalid value: %s', e)
     return qs
 
 
-def __gen_quick_query_params(value, fields, int_fields):
+def __gen_quick_query_params(value, lookups, int_lookups, search_q=None):
     q = Q()
     if not value:
         return q
-    for field in fields:
-        d = {"%s__icontains" % field: value}
-        q = q | Q(**d)
+    if search_q is not None:
+        q = search_q
+    else:
+        for lookup, field, lower in lookups:
+            if field is not None and not _can_match(field, value):
+                continue
+            q = q | Q(**{lookup: value.lower() if lower else value})
     if value.isdigit():
-        for f in int_fields:
-            d = {f: value}
-            q = q | Q(**d)
+        for lookup in int_lookups:
+            q = q | Q(**{lookup: value})
+    if not q and any(e[1] is not None for e in lookups):
+        return Q(pk__in=[])  # the keyword can not match any typed field
     return q
 
 
-def __gen_query_params(qdata):
+def _in_target_field(field):
+    if field.many_to_many:
+        return field.related_model._meta.pk
+    if field.is_relation:
+        return field.target_field
+    return field
+
+
+def in_list_q(lookup, field, values, using='default', strategy=None):
+    """
+    Q of a large `__in` filter which does not pass every value as a sql param.
+
+    lookup: ex: 'pk__in'
+    field: field of the lookup, see `resolve_lookup`
+    values: list of values
+    using: database alias of the query
+    strategy: settings.LBUTILS_IN_LIST_STRATEGY, default is 'auto'
+        'auto': 'json' for SQLite, 'array' for PostgreSQL, else 'chunked'
+        'json': one json param read by `json_each`(SQLite)
+        'array': one array param read by `unnest`(PostgreSQL)
+        'chunked': OR of `__in` filters of settings.LBUTILS_IN_LIST_THRESHOLD values
+    """
+    connection = connections[using]
+    strategy = strategy or getattr(settings, 'LBUTILS_IN_LIST_STRATEGY', 'auto')
+    if strategy == 'auto':
+        strategy = 'chunked'
+        # supports_json_field is added in Django 3.1
+        if connection.vendor == 'sqlite' and getattr(connection.features, 'supports_json_field', False):
+            strategy = 'json'
+        elif connection.vendor == 'postgresql':
+            strategy = 'array'
+    field = _in_target_field(field)
+    values = [field.to_python(e) for e in values]
+    if strategy == 'json':
+        # values as stored by the database, ex: datetimes and UUIDs are text in SQLite
+        values = [field.get_db_prep_value(e, connection) for e in values]
+        sql = 'SELECT value FROM json_each(%s)'
+        return Q(**{lookup: RawSQL(sql, [json.dumps(values, cls=DjangoJSONEncoder)])})
+    if strategy == 'array':
+        sql = 'SELECT unnest(%%s::%s[])' % field.cast_db_type(connection)
+        values = [field.get_db_prep_value(e, connection) for e in values]
+        return Q(**{lookup: RawSQL(sql, [values])})
+    size = getattr(settings, 'LBUTILS_IN_LIST_THRESHOLD', 500)
+    q = Q()
+    for idx in range(0, len(values), size):
+        q = q | Q(**{lookup: values[idx:idx + size]})
+    return q
+
+
+def __gen_query_params(lookups, qdata, using='default'):
     q = Q()
     kw_query_params = {}
-    for k, v in qdata.items():
-        if k.startswith('q__'):
-            k = k[3:]
-            if not isinstance(v, str):
-                if v is not None:
-                    kw_query_params[k] = v
-                continue
-            if v == '':
-                continue
-            v = v.replace('，', ',')
-            if v.startswith('F__'):
-                v = F(v[3:])
-            elif k.endswith('__in'):
-                v = [e for e in v.split(',') if e]
-            elif ',' in v:
-                tmp_q = Q()
-                v = [e for e in v.split(',') if e]
-                for o in v:
-                    tmp_q = tmp_q | Q(**{k: o})
-                q = q & tmp_q
+    for qk, k, field, lookup_name in lookups:
+        v = qdata.get(qk)
+        if not isinstance(v, str):
+            if v is not None:
+                kw_query_params[k] = v
+            continue
+        if v == '':
+            continue
+        v = v.replace('，', ',')
+        if v.startswith('F__'):
+            v = F(v[3:])
+        elif lookup_name == 'in':
+            v = [e for e in v.split(',') if e]
+            if len(v) > getattr(settings, 'LBUTILS_IN_LIST_THRESHOLD', 500):
+                q = q & in_list_q(k, field, v, using)
                 continue
-            if isinstance(v, str):
-                v = {'__True': True, '__False': False}.get(v, v)
-            kw_query_params[k] = v
+        elif ',' in v:
+            tmp_q = Q()
+            v = [e for e in v.split(',') if e]
+            for o in v:
+                tmp_q = tmp_q | Q(**{k: o})
+            q = q & tmp_q
+            continue
+        if isinstance(v, str):
+            v = {'__True': True, '__False': False}.get(v, v)
+        kw_query_params[k] = v
     return q, kw_query_params
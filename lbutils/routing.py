@@ -0,0 +1,85 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+try:
+    from asgiref.local import Local
+except ImportError:
+    Local = threading.local
+
+__all__ = (
+    'pin_primary', 'unpin_primary', 'is_primary_pinned', 'primary_pin_scope', 'read_qs',
+)
+
+_local = Local()
+
+
+def pin_primary():
+    """
+    send reads of the read-only helpers to the primary database, so the
+    writes of this request are read back.
+
+    Called on post_save/post_delete/m2m_changed of the primary database in a
+    `primary_pin_scope`, call it after writes which do not send signals,
+    ex: `qs.update()`. The pin is reset when the scope exits.
+    """
+    _local.pinned = True
+
+
+def unpin_primary():
+    _local.pinned = False
+
+
+def is_primary_pinned():
+    return getattr(_local, 'pinned', False)
+
+
+@contextmanager
+def primary_pin_scope():
+    """
+    scope the pin of `pin_primary`: writes to the primary database
+    (settings.LBUTILS_PRIMARY_DB, default is 'default') in the block pin
+    the reads of the thread to it until the block exits.
+    `lbutils.middleware.ReadReplicaMiddleware` runs each request in a scope.
+
+    Writes outside a scope(ex: management commands, workers) do not pin,
+    wrap the work in a scope to read its writes back.
+    """
+    saved = getattr(_local, 'scoped', False), is_primary_pinned()
+    _local.scoped, _local.pinned = True, False
+    try:
+        yield
+    finally:
+        _local.scoped, _local.pinned = saved
+
+
+def read_qs(qs, using=None):
+    """
+    route qs of a read-only helper.
+
+    using: database alias, default is settings.LBUTILS_READ_DB. qs is not
+        changed if it is not set, qs has a database(`qs.using()`) or
+        the primary database is pinned, see `pin_primary`.
+    """
+    if using:
+        return qs.using(using)
+    using = getattr(settings, 'LBUTILS_READ_DB', None)
+    if not using or qs._db is not None or is_primary_pinned():
+        return qs
+    return qs.using(using)
+
+
+def _on_write(sender, instance, **kwargs):
+    if not getattr(_local, 'scoped', False) or not kwargs.get('action', 'post_').startswith('post_'):
+        return
+    using = kwargs.get('using') or instance._state.db  # m2m_changed has no using
+    if using == getattr(settings, 'LBUTILS_PRIMARY_DB', DEFAULT_DB_ALIAS):
+        pin_primary()
+
+
+post_save.connect(_on_write, dispatch_uid='lbutils:routing')
+post_delete.connect(_on_write, dispatch_uid='lbutils:routing')
+m2m_changed.connect(_on_write, dispatch_uid='lbutils:routing')
@@ -0,0 +1,273 @@
+import itertools
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .utils import create_instance
+
+__all__ = (
+    'BaseSearchBackend', 'IcontainsSearchBackend', 'SqliteFTSSearchBackend',
+    'PostgresSearchBackend', 'get_search_backend', 'register_search_index',
+    'unregister_search_index', 'get_search_index', 'search_indexes',
+)
+
+search_indexes = {}
+_m2m_indexes = {}  # through model: {(indexed model, m2m field name)}
+
+
+class BaseSearchBackend(object):
+    """
+    search backend for the quick search keyword of `do_filter`.
+    """
+
+    def get_q(self, model, keyword, fields):
+        """ return a Q to filter model by keyword """
+        raise NotImplementedError
+
+    def build_index(self, model, fields):
+        """ build or rebuild the index of model """
+        pass
+
+    def update_index(self, instance, fields):
+        """ update the index of a saved object """
+        pass
+
+    def delete_index(self, instance):
+        """ remove a deleted object from the index """
+        pass
+
+
+class IcontainsSearchBackend(BaseSearchBackend):
+    """
+    `icontains` on every field, no index needed.
+    """
+
+    def get_q(self, model, keyword, fields):
+        q = Q()
+        for field in fields:
+            q = q | Q(**{'%s__icontains' % field: keyword})
+        return q
+
+
+def _index_rows(qs, fields):
+    """ yield (pk, [text of each field]), values of to-many fields are joined """
+    rows = qs.order_by('pk').values_list('pk', *fields).iterator()
+    for pk, group in itertools.groupby(rows, key=lambda e: e[0]):
+        values = [[] for e in fields]
+        for row in group:
+            for idx, value in enumerate(row[1:]):
+                if value is not None and '%s' % value not in values[idx]:
+                    values[idx].append('%s' % value)
+        yield pk, [' '.join(e) for e in values]
+
+
+class SqliteFTSSearchBackend(BaseSearchBackend):
+    """
+    SQLite FTS5 index, kept in the virtual table `lbutils_fts_<db_table>`.
+
+    Each word of the keyword is matched as a prefix. Until the index is built
+    by `build_index`, the search falls back to `IcontainsSearchBackend` and
+    saves do not create a partial index.
+    tokenize: FTS5 tokenizer, ex: 'trigram' for substring match(SQLite 3.34+)
+    """
+
+    def __init__(self, tokenize='unicode61'):
+        self.tokenize = tokenize
+
+    def get_table(self, model):
+        return 'lbutils_fts_%s' % model._meta.db_table
+
+    def has_index(self, model, using):
+        with connections[using].cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [self.get_table(model)])
+            return cursor.fetchone() is not None
+
+    def get_q(self, model, keyword, fields):
+        words = ['"%s"*' % e.replace('"', '""') for e in keyword.split()]
+        if not words:
+            return Q()
+        if not self.has_index(model, router.db_for_read(model)):
+            return IcontainsSearchBackend().get_q(model, keyword, fields)
+        table = self.get_table(model)
+        sql = 'SELECT rowid FROM %s WHERE %s MATCH %%s' % (table, table)
+        return Q(pk__in=RawSQL(sql, [' '.join(words)]))
+
+    def _create_table(self, cursor, model, fields, drop=False):
+        table = self.get_table(model)
+        if drop:
+            cursor.execute('DROP TABLE IF EXISTS %s' % table)
+        columns = ', '.join('f%s' % idx for idx in range(len(fields)))
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize=%s)' % (
+            table, columns, "'%s'" % self.tokenize))
+
+    def _insert(self, cursor, model, fields, rows):
+        sql = 'INSERT INTO %s(rowid, %s) VALUES (%s)' % (
+            self.get_table(model),
+            ', '.join('f%s' % idx for idx in range(len(fields))),
+            ', '.join(['%s'] * (len(fields) + 1)))
+        while True:
+            chunk = [[pk] + values for pk, values in itertools.islice(rows, 1000)]
+            if not chunk:
+                return
+            cursor.executemany(sql, chunk)
+
+    def build_index(self, model, fields):
+        using = router.db_for_write(model)
+        with connections[using].cursor() as cursor:
+            self._create_table(cursor, model, fields, drop=True)
+            rows = _index_rows(model._default_manager.using(using).all(), fields)
+            self._insert(cursor, model, fields, rows)
+
+    def update_index(self, instance, fields):
+        model = type(instance)
+        using = router.db_for_write(model, instance=instance)
+        if not self.has_index(model, using):
+            return
+        with connections[using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.get_table(model), [instance.pk])
+            rows = _index_rows(model._default_manager.using(using).filter(pk=instance.pk), fields)
+            self._insert(cursor, model, fields, rows)
+
+    def delete_index(self, instance):
+        model = type(instance)
+        using = router.db_for_write(model, instance=instance)
+        if not self.has_index(model, using):
+            return
+        with connections[using].cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid = %%s' % self.get_table(model), [instance.pk])
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    PostgreSQL search, needs 'django.contrib.postgres' in INSTALLED_APPS.
+
+    mode: 'tsvector' for full text search, 'trigram' for similarity search
+        (needs the pg_trgm extension).
+    config: text search config of 'tsvector' mode, ex: 'english'
+    """
+
+    def __init__(self, mode='tsvector', config=None):
+        self.mode = mode
+        self.config = config
+
+    def get_q(self, model, keyword, fields):
+        if self.mode == 'trigram':
+            q = Q()
+            for field in fields:
+                q = q | Q(**{'%s__trigram_similar' % field: keyword})
+            return q
+        from django.contrib.postgres.search import SearchQuery, SearchVector
+        qs = model._default_manager.annotate(
+            lbutils_search=SearchVector(*fields, config=self.config)
+        ).filter(lbutils_search=SearchQuery(keyword, config=self.config))
+        return Q(pk__in=qs.values('pk'))
+
+    def build_index(self, model, fields):
+        """
+        create trigram GIN indexes on the local fields in 'trigram' mode,
+        they are used by `trigram_similar` and `icontains`.
+        For 'tsvector' mode add a GIN index on the search vector in a migration.
+        """
+        if self.mode != 'trigram':
+            return
+        table = model._meta.db_table
+        using = router.db_for_write(model)
+        with connections[using].cursor() as cursor:
+            for field in fields:
+                if '__' in field:
+                    continue
+                column = model._meta.get_field(field).column
+                cursor.execute(
+                    'CREATE INDEX IF NOT EXISTS "lbutils_trgm_%s_%s" ON "%s" USING gin ("%s" gin_trgm_ops)' % (
+                        table, column, table, column))
+
+
+def get_search_backend():
+    """
+    default search backend, settings.LBUTILS_SEARCH_BACKEND,
+    default is "lbutils.search.IcontainsSearchBackend"
+    """
+    backend = getattr(settings, 'LBUTILS_SEARCH_BACKEND', 'lbutils.search.IcontainsSearchBackend')
+    return create_instance(backend)
+
+
+def _on_save(sender, instance, **kwargs):
+    fields, backend = search_indexes[sender]
+    backend.update_index(instance, fields)
+
+
+def _on_delete(sender, instance, **kwargs):
+    fields, backend = search_indexes[sender]
+    backend.delete_index(instance)
+
+
+def _on_m2m_changed(sender, instance, action, pk_set, **kwargs):
+    for model, name in _m2m_indexes.get(sender, ()):
+        fields, backend = search_indexes[model]
+        if isinstance(instance, model):
+            if action.startswith('post_'):
+                backend.update_index(instance, fields)
+            continue
+        # instance is the related object, pk_set are pks of model
+        if action == 'pre_clear':
+            qs = model._default_manager.filter(**{name: instance})
+            instance._lbutils_search_cleared = list(qs.values_list('pk', flat=True))
+            continue
+        if action == 'post_clear':
+            pk_set = instance.__dict__.pop('_lbutils_search_cleared', ())
+        elif not action.startswith('post_'):
+            continue
+        for obj in model._default_manager.filter(pk__in=pk_set or ()):
+            backend.update_index(obj, fields)
+
+
+def _m2m_fields(model, fields):
+    """ yield (through model, name) of the many-to-many relations of fields """
+    names = {e.split('__')[0] for e in fields}
+    for name in sorted(names):
+        field = model._meta.get_field(name)
+        if field.many_to_many:
+            through = getattr(field, 'through', None) or field.remote_field.through
+            yield through, name
+
+
+def register_search_index(model, fields, backend=None):
+    """
+    search model by a backend for the quick search keyword of `do_filter`,
+    the index is updated on post_save/post_delete and m2m_changed of the
+    many-to-many relations of fields.
+
+    Call it at startup(ex: `AppConfig.ready`), build the index with the
+    `rebuildsearchindex` command. Changes of other related objects(ex: renaming
+    a category) do not update the index, rebuild it periodically if fields span relations.
+    fields: field names, ex: `['name', 'category__name']`
+    backend: a `BaseSearchBackend`, default is `get_search_backend()`
+    """
+    search_indexes[model] = (list(fields), backend or get_search_backend())
+    uid = 'lbutils:search:%s' % model._meta.label_lower
+    post_save.connect(_on_save, sender=model, dispatch_uid=uid)
+    post_delete.connect(_on_delete, sender=model, dispatch_uid=uid)
+    for through, name in _m2m_fields(model, fields):
+        _m2m_indexes.setdefault(through, set()).add((model, name))
+        m2m_changed.connect(_on_m2m_changed, sender=through, dispatch_uid='lbutils:search')
+
+
+def unregister_search_index(model):
+    uid = 'lbutils:search:%s' % model._meta.label_lower
+    post_save.disconnect(sender=model, dispatch_uid=uid)
+    post_delete.disconnect(sender=model, dispatch_uid=uid)
+    for through, indexes in list(_m2m_indexes.items()):
+        indexes.difference_update({e for e in indexes if e[0] is model})
+        if not indexes:
+            del _m2m_indexes[through]
+            m2m_changed.disconnect(sender=through, dispatch_uid='lbutils:search')
+    search_indexes.pop(model, None)
+
+
+def get_search_index(model):
+    """ return (fields, backend) registered for model, None if not registered """
+    return search_indexes.get(model)
@@ -1,3 +1,5 @@
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
 
@@ -35,3 +37,15 @@ class Book(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class Event(models.Model):
+    name = models.CharField(max_length=255)
+    created = models.DateTimeField()
+    book = models.ForeignKey(Book, null=True, blank=True, on_delete=models.CASCADE)
+    content_type = models.ForeignKey(ContentType, null=True, blank=True, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField(null=True, blank=True)
+    obj = GenericForeignKey('content_type', 'object_id')
+
+    def __str__(self):
+        return self.name
@@ -1,16 +1,48 @@
+import asyncio
+import os
 from unittest import skipUnless
 
 import django
-from django.http import QueryDict
-from django.test import TestCase
-from lbutils import (QuickSearchForm, create_instance, do_filter, fmt_month,
-                     fmt_num, format_filesize, forms_is_valid, get_max,
-                     get_or_none, get_pk_or_none, get_sum, get_year_choices,
-                     qdict_get_list, render_json, simple_export2xlsx)
+from django.core.exceptions import FieldError
+from django.core.paginator import InvalidPage
+from django.http import Http404, QueryDict
+from django.db import connection, models
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase
+from lbutils import (FilterPlanner, KeysetPaginator, QuickSearchForm,
+                     SqliteFTSSearchBackend, acount_filtered, aget_aggregates,
+                     aget_max, aget_or_none, aget_pk_or_none, aget_sum,
+                     auto_related, bump_model_version, cleanup_export_jobs,
+                     compile_filter, count_filtered, create_instance,
+                     detect_related, do_filter, enqueue_export,
+                     evict_export_cache, export_cache_key, export_job_download,
+                     export_job_status, fmt_month, fmt_num, format_filesize,
+                     forms_is_valid, get_aggregates, get_cached_export,
+                     get_export_job, get_export_watermark, get_many_or_none,
+                     get_max, get_model_version, get_or_none, get_pk_or_none,
+                     get_search_backend, get_sum, get_year_choices,
+                     identity_map, in_list_q, is_primary_pinned,
+                     iter_delta_rows, iter_export_rows, iter_keyset,
+                     iter_partitioned_rows, pin_primary, pk_ranges,
+                     primary_pin_scope, private_dir, qdict_get_list,
+                     recover_export_jobs, register_cached_lookup,
+                     register_search_index, render_json, resolve_lookup,
+                     run_export_jobs, search_indexes, set_export_watermark,
+                     simple_export2csv, simple_export2xlsx, simple_import_xlsx,
+                     unpin_primary, unregister_cached_lookup,
+                     unregister_search_index, xlsw_write_rows,
+                     xlsw_write_sheet_pipelined, xlsw_write_summary)
+from lbutils.cacheutils import check_lbutils_cache
+from lbutils.middleware import ReadReplicaMiddleware
 from lbutils.templatetags.lbutils import display_array, get_setting
 
 from .forms import BookForm
-from .models import Author, Book, Category
+from .models import Author, Book, Category, Event
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:  # Django < 3.0
+    async_to_sync = None
 
 
 class DateUtilsTests(TestCase):
@@ -77,6 +109,47 @@ class QSTests(TestCase):
             Book.objects.get(name='book-01').pk,
             get_pk_or_none(Book, name='book-01'))
 
+    def test_get_many_or_none(self):
+        pk = Book.objects.get(name='book-01').pk
+        with self.assertNumQueries(1):
+            books = get_many_or_none(Book, ['%s' % pk, 0])
+        self.assertEqual({'%s' % pk: Book.objects.get(pk=pk), 0: None}, books)
+        books = get_many_or_none(Book, ['book-02', 'xx'], field='name')
+        self.assertEqual(['book-02', None], [e and e.name for e in books.values()])
+        with self.assertNumQueries(1):
+            books = get_many_or_none(Book, ['%s' % pk, 'x1', None])
+        self.assertEqual({'%s' % pk: Book.objects.get(pk=pk), 'x1': None, None: None}, books)
+
+    def test_identity_map(self):
+        pk = Book.objects.get(name='book-01').pk
+        with identity_map():
+            with self.assertNumQueries(2):
+                book = get_or_none(Book, pk=pk)
+                self.assertIs(book, get_or_none(Book, id='%s' % pk))
+                self.assertEqual(pk, get_pk_or_none(Book, pk=pk))
+                self.assertIsNone(get_or_none(Book, name='xx'))
+                self.assertIsNone(get_or_none(Book, name='xx'))
+            with self.assertNumQueries(1):
+                get_many_or_none(Book, [pk, pk + 1])
+                get_or_none(Book, pk=pk + 1)
+            Book.objects.create(name='xx')
+            self.assertEqual('xx', get_or_none(Book, name='xx').name)
+        with self.assertNumQueries(1):
+            get_or_none(Book, pk=pk)
+
+    def test_cached_lookup(self):
+        register_cached_lookup(Category)
+        self.addCleanup(unregister_cached_lookup, Category)
+        self.assertEqual('category-01', get_or_none(Category, name='category-01').name)
+        self.assertIsNone(get_or_none(Category, name='xx'))
+        with self.assertNumQueries(0):
+            category = get_or_none(Category, name='category-01')
+            self.assertIsNone(get_or_none(Category, name='xx'))
+        category.name = 'xx'
+        category.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(category.pk, get_pk_or_none(Category, name='xx'))
+
     def test_get_sum(self):
         qs = Book.objects.all()
         self.assertEqual(300, get_sum(qs, 'price'))
@@ -87,6 +160,207 @@ class QSTests(TestCase):
         qs = Book.objects.all()
         self.assertEqual(200, get_max(qs, 'price'))
 
+    def test_get_aggregates(self):
+        qs = Book.objects.all()
+        with self.assertNumQueries(1):
+            data = get_aggregates(qs, sum=['price'], max=['price'], min=['price'], count=True)
+        self.assertEqual({'price__sum': 300, 'price__max': 200, 'price__min': 100, 'count': 3}, data)
+        data = get_aggregates(qs.filter(price=None), sum=['price'], avg=['price'])
+        self.assertEqual({'price__sum': 0, 'price__avg': 0}, data)
+        data = get_aggregates(qs, sum=['price'], group_by='category__name')
+        self.assertEqual({None: {'price__sum': 0}, 'category-01': {'price__sum': 300}}, data)
+        data = get_aggregates(qs, count='authors', group_by='name')
+        self.assertEqual([2, 0, 0], [e['authors__count'] for e in data.values()])
+        data = get_aggregates(qs, count=True, group_by=['category__name', 'is_active'])
+        self.assertEqual({'count': 2}, data[('category-01', True)])
+
+    def test_get_aggregates_cache(self):
+        qs = Book.objects.filter(is_active=True)
+        self.assertEqual(300, get_sum(qs, 'price', cache_timeout=60))
+        with self.assertNumQueries(0):
+            self.assertEqual(300, get_sum(qs, 'price', cache_timeout=60))
+        Book.objects.create(name='book-04', price=50)
+        self.assertEqual(350, get_sum(qs, 'price', cache_timeout=60))
+        self.assertEqual(200, get_max(qs, 'price', cache_timeout=60))
+        qs.update(price=1)
+        bump_model_version(Book)
+        self.assertEqual(1, get_max(qs, 'price', cache_timeout=60))
+
+    def test_model_version_signals(self):
+        version = get_model_version(Author)
+        Author.objects.create(name='author-new')
+        self.assertNotEqual(version, get_model_version(Author))
+        version = get_model_version(Book.authors.through)
+        Book.objects.first().authors.clear()
+        self.assertNotEqual(version, get_model_version(Book.authors.through))
+        self.assertEqual([], check_lbutils_cache())
+        with self.settings(LBUTILS_CACHE='default'):
+            self.assertEqual(['lbutils.W001'], [e.id for e in check_lbutils_cache()])
+
+    def test_count_filtered(self):
+        qs = do_filter(Book.objects.all(), {'q__is_active': '__True'})
+        self.assertEqual(2, count_filtered(qs, 'exact'))
+        count = count_filtered(Book.objects.all(), 'capped', cap=2)
+        self.assertEqual((2, False, '2+'), (count, count.exact, count.display))
+        count = count_filtered(qs, 'estimate', cap=2)
+        self.assertEqual((2, True, '2'), (count, count.exact, count.display))
+        self.assertEqual(2, count_filtered(qs, 'cached'))
+        with self.assertNumQueries(0):
+            self.assertEqual(2, count_filtered(qs, 'cached'))
+        Book.objects.create(name='book-04')
+        self.assertEqual(3, count_filtered(qs, 'cached'))
+        self.assertEqual(4, count_filtered(Book.objects.all()))
+
+    @skipUnless(async_to_sync, 'asgiref is not installed')
+    def test_async_helpers(self):
+        qs = Book.objects.all()
+
+        async def run():
+            return await asyncio.gather(
+                aget_or_none(Book, name='book-01'), aget_or_none(Book, name='xx'),
+                aget_pk_or_none(Book, name='xx'), aget_sum(qs, 'price'), aget_max(qs, 'price'),
+                aget_aggregates(qs, min=['price'], count=True),
+                acount_filtered(qs, 'exact'), acount_filtered(qs, 'capped', cap=2), acount_filtered(qs, cap=2))
+        book, none, pk, price_sum, price_max, data, count, capped, auto = async_to_sync(run)()
+        self.assertEqual((2, '2+'), (auto, auto.display))
+        self.assertEqual(('book-01', None, None), (book.name, none, pk))
+        self.assertEqual((300, 200), (price_sum, price_max))
+        self.assertEqual({'price__min': 100, 'count': 3}, data)
+        self.assertEqual((3, '2+'), (count, capped.display))
+
+    def test_keyset_paginator(self):
+        for idx in range(4, 8):
+            Book.objects.create(name='book-%02d' % idx, price=idx % 2)
+        paginator = KeysetPaginator(do_filter(Book.objects.all(), {}), 3)
+        page = paginator.page()
+        self.assertEqual(['book-01', 'book-02', 'book-03'], [e.name for e in page])
+        self.assertFalse(page.has_previous())
+        with self.assertNumQueries(1):
+            page = paginator.page(page.next_cursor)
+        self.assertEqual(['book-04', 'book-05', 'book-06'], [e.name for e in page])
+        page = paginator.page(page.next_cursor)
+        self.assertEqual(['book-07'], [e.name for e in page])
+        self.assertFalse(page.has_next())
+        page = paginator.page(page.previous_cursor)
+        self.assertEqual(['book-04', 'book-05', 'book-06'], [e.name for e in page])
+        page = paginator.page(page.previous_cursor)
+        self.assertEqual(['book-01', 'book-02', 'book-03'], [e.name for e in page])
+        self.assertFalse(page.has_previous())
+        paginator = KeysetPaginator(Book.objects.filter(price__lt=2), 2, ['-price', 'name'])
+        page = paginator.page(paginator.page().next_cursor)
+        self.assertEqual(['book-04', 'book-06'], [e.name for e in page])
+        with self.assertRaises(InvalidPage):
+            paginator.page('xx')
+
+    def test_keyset_paginator_datetime_fk(self):
+        from datetime import datetime
+        books = list(Book.objects.order_by('-pk'))  # book-03 has the largest pk, but is ordered last
+        for idx in range(6):
+            Event.objects.create(
+                name='e%s' % idx, created=datetime(2020, 1, 1, 0, 0, 0, idx * 10), book=books[idx % 3])
+
+        def names(paginator):
+            result, page = [], paginator.page()
+            for idx in range(10):
+                result.extend(e.name for e in page)
+                if not page.has_next():
+                    break
+                page = paginator.page(page.next_cursor)
+            return result
+        self.assertEqual(['e%s' % i for i in range(6)], names(KeysetPaginator(Event.objects.all(), 2, ['created'])))
+        paginator = KeysetPaginator(Event.objects.all(), 2, ['-created'])
+        self.assertEqual(['e%s' % i for i in range(5, -1, -1)], names(paginator))
+        events = sorted(Event.objects.all(), key=lambda e: (e.book_id, e.pk))
+        self.assertEqual([e.name for e in events], names(KeysetPaginator(Event.objects.all(), 2, ['book'])))
+
+    def test_detect_related(self):
+        qs = Book.objects.all()
+
+        def func_data(o):
+            return [o.name, o.category and o.category.name, [e.name for e in o.authors.all()]]
+        self.assertEqual(([], []), detect_related(qs, lambda o: [o.name]))
+        self.assertEqual((['category'], ['authors']), detect_related(qs, func_data))
+        self.assertEqual(([], ['book_set']), detect_related(
+            Category.objects.all(), lambda o: [e.name for e in o.book_set.all()]))
+        self.assertEqual(([], ['book_set']), detect_related(
+            Author.objects.all(), lambda o: [e.name for e in o.book_set.all()]))
+        # joins the through table, but is not a query of the related manager
+        self.assertEqual(([], []), detect_related(
+            Author.objects.all(), lambda o: [Book.objects.filter(authors__name=o.name).count()]))
+        from datetime import datetime
+        book = Book.objects.get(name='book-01')
+        Event.objects.create(name='e', created=datetime(2020, 1, 1), book=book, obj=book)
+        # GenericForeignKey can not be selected
+        events = auto_related(Event.objects.all(), lambda o: [o.obj.name, o.book.name])
+        self.assertEqual([['book-01', 'book-01']], [[o.obj.name, o.book.name] for o in events])
+        self.assertEqual(('book',), tuple(events.query.select_related))
+        qs = auto_related(qs, func_data)
+        with self.assertNumQueries(2):
+            rows = [func_data(o) for o in qs]
+        self.assertEqual(['book-01', 'category-01', ['author-01', 'author-02']], rows[0])
+
+    def test_iter_keyset(self):
+        qs = Book.objects.all()
+        rows = list(iter_keyset(qs, 'price', chunk_size=1))
+        self.assertEqual(['book-03', 'book-01', 'book-02'], [e[1].name for e in rows])
+        key = rows[1][0]
+        self.assertEqual((100, Book.objects.get(name='book-01').pk), key)
+        Book.objects.create(name='book-04', price=100)
+        rows = list(iter_keyset(qs, 'price', start=key, columns=['name']))
+        self.assertEqual([('book-04',), ('book-02',)], [e[1] for e in rows])
+        with self.assertNumQueries(3):
+            self.assertEqual(4, len(list(iter_keyset(qs, chunk_size=2))))
+
+    def test_resolve_lookup(self):
+        field, lookup_name = resolve_lookup(Book, 'category__name__icontains')
+        self.assertEqual(('name', 'icontains'), (field.name, lookup_name))
+        field, lookup_name = resolve_lookup(Book, 'pk__in')
+        self.assertEqual(('id', 'in'), (field.name, lookup_name))
+        field, lookup_name = resolve_lookup(Book, 'category')
+        self.assertEqual(('category', 'exact'), (field.name, lookup_name))
+        field, lookup_name = resolve_lookup(Category, 'book__name__startswith')
+        self.assertEqual('startswith', lookup_name)
+        from django.db.models import CharField
+        from django.db.models.functions import Lower
+        from django.test.utils import register_lookup
+        with register_lookup(CharField, Lower):
+            field, lookup_name = resolve_lookup(Book, 'name__lower__startswith')
+            self.assertEqual('startswith', lookup_name)
+            field, lookup_name = resolve_lookup(Book, 'name__lower')
+            self.assertEqual('exact', lookup_name)
+        for lookup in ['not_exist', 'name__not_exist', 'category__not_exist', 'name__lower__xx']:
+            with self.assertRaises(FieldError):
+                resolve_lookup(Book, lookup)
+
+    def test_do_filter_invalid(self):
+        books = Book.objects.all()
+        compile_filter.cache_clear()
+        with self.assertLogs('lbutils.qs', 'WARNING'):
+            qs = do_filter(books, {'q__not_exist': '1', 'q__price': '100'})
+        self.assertEqual(1, qs.count())
+        self.assertEqual(1, compile_filter.cache_info().misses)
+        with self.assertLogs('lbutils.qs', 'WARNING'):
+            do_filter(books, {'q__not_exist': '2', 'q__price': '200'})
+        self.assertEqual(1, compile_filter.cache_info().hits)
+        with self.assertRaises(FieldError):
+            do_filter(books, {'q__not_exist': '1'}, strict=True)
+        with self.assertRaises(ValueError):
+            do_filter(books, {'q__price': 'abc'}, strict=True)
+        with self.assertRaises(FieldError):
+            do_filter(books, {}, ['not_exist'], strict=True)
+        with self.assertLogs('lbutils.qs', 'WARNING'):
+            qs = do_filter(books, {'q_quick_search_kw': 'book-01'}, ['not_exist', 'name'], ['xx'])
+        self.assertEqual(1, qs.count())
+
+    def test_do_filter_annotations(self):
+        books = Book.objects.annotate(n=Count('authors'))
+        self.assertEqual(1, do_filter(books, {'q__n__gte': '1'}, strict=True).count())
+        self.assertEqual(2, do_filter(books, {'q__n': '0'}, strict=True).count())
+        with self.assertRaises(FieldError):
+            do_filter(books, {'q__n__xx': '1'}, strict=True)
+        with self.assertRaises(FieldError):
+            do_filter(Book.objects.all(), {'q__n': '1'}, strict=True)
+
     def test_do_filter_quick_query_fields(self):
         books = Book.objects.all()
         qdata = {'q_quick_search_kw': ''}
@@ -108,6 +382,75 @@ class QSTests(TestCase):
         qs = do_filter(books, qdata, ['name', 'category__name'], int_quick_query_fields=['price'])
         self.assertEqual(1, qs.count())
 
+    def test_do_filter_quick_search_modes(self):
+        books = Book.objects.all()
+        fields = [('name', 'istartswith'), ('price', 'exact'), ('descn', 'prefix')]
+        qs = do_filter(books, {'q_quick_search_kw': 'BOOK-0'}, fields)
+        self.assertEqual(3, qs.count())
+        qs = do_filter(books, {'q_quick_search_kw': 'DESC'}, fields)
+        self.assertEqual(3, qs.count())
+        qs = do_filter(books, {'q_quick_search_kw': 'ook'}, fields)
+        self.assertEqual(0, qs.count())
+        # text fields are skipped for digits
+        qs = do_filter(books, {'q_quick_search_kw': '200'}, fields)
+        self.assertEqual(['book-02'], [e.name for e in qs])
+        with self.assertRaises(FieldError):
+            do_filter(books, {'q_quick_search_kw': 'a'}, [('name', 'regex')], strict=True)
+        # no field can match the keyword
+        self.assertEqual(0, do_filter(books, {'q_quick_search_kw': '123'}, [('name', 'istartswith')]).count())
+        self.assertEqual(0, do_filter(books, {'q_quick_search_kw': 'zzz'}, [('price', 'exact')]).count())
+        qdata = {'q_quick_search_kw': '1.5', 'q__name': 'book-01'}
+        self.assertEqual(0, do_filter(books, qdata, [('id', 'exact')], strict=True).count())
+        qdata = {'q_quick_search_kw': '100', 'q__name': 'book-01'}
+        self.assertEqual(1, do_filter(books, qdata, [('id', 'exact'), ('price', 'exact')], strict=True).count())
+        # relations are matched by the type of their target field
+        fields = [('category', 'exact'), ('name', 'istartswith')]
+        qdata = {'q_quick_search_kw': 'book', 'q__price': '200'}
+        self.assertEqual(['book-02'], [e.name for e in do_filter(books, qdata, fields)])
+        qdata = {'q_quick_search_kw': '%s' % books.get(name='book-01').category_id}
+        self.assertEqual(['book-01', 'book-02'], [e.name for e in do_filter(books, qdata, fields)])
+        # untyped fields keep every row if the keyword can not match
+        self.assertEqual(3, do_filter(books, {'q_quick_search_kw': 'abc'}, [], ['price']).count())
+
+    def test_do_filter_large_in(self):
+        books = Book.objects.all()
+        pks = [e.pk for e in books[:2]]
+        qdata = {'q__pk__in': ','.join('%s' % e for e in pks + list(range(1000, 3000)))}
+        qs = do_filter(books, qdata, strict=True)
+        self.assertIn('json_each', '%s' % qs.query)
+        self.assertEqual(pks, [e.pk for e in qs])
+        qdata = {'q__category__in': ','.join(['%s' % books[0].category_id] * 600)}
+        self.assertEqual(2, do_filter(books, qdata, strict=True).count())
+        with self.settings(LBUTILS_IN_LIST_STRATEGY='chunked', LBUTILS_IN_LIST_THRESHOLD=1):
+            qs = do_filter(books, {'q__name__in': 'book-01,book-02'}, strict=True)
+            self.assertEqual(2, qs.count())
+        field = models.DateTimeField()
+        q = in_list_q('created__in', field, ['2020-01-02 03:04:05'], strategy='json')
+        self.assertEqual(['["2020-01-02 03:04:05"]'], q.children[0][1].params)
+        field = models.UUIDField()
+        q = in_list_q('uuid__in', field, ['12345678-1234-5678-1234-567812345678'], strategy='json')
+        self.assertEqual(['["12345678123456781234567812345678"]'], q.children[0][1].params)
+
+    def test_do_filter_planner(self):
+        books = Book.objects.all()
+        planner = FilterPlanner()
+        self.assertEqual({'id', 'category'}, planner.indexed_fields(Book))
+        with self.assertLogs('lbutils.planner', 'WARNING') as logs:
+            qs = do_filter(books, {'q__name': 'book-01', 'q__category': '', 'q__pk__gt': '0'}, planner=planner)
+        self.assertEqual(1, qs.count())
+        self.assertIn("['q__name']", logs.output[0])
+        self.assertEqual(['q__name', 'q__pk__gt'], planner.keys)
+        planner = FilterPlanner('reject', slow_ms=0)
+        with self.assertLogs('lbutils.qs', 'WARNING'):
+            qs = do_filter(books, {'q__name__icontains': 'book-01', 'q__authors__pk': '1'}, planner=planner)
+        with self.assertLogs('lbutils.planner', 'WARNING') as logs:
+            with planner.timed(qs):
+                self.assertEqual(1, len(qs))
+        self.assertIn('slow filter', logs.output[0])
+        self.assertIn("keys: ['q__authors__pk']", logs.output[0])
+        with self.assertRaises(FieldError):
+            do_filter(books, {'q__category__name': 'xx'}, strict=True, planner=planner)
+
     def test_do_filter(self):
         books = Book.objects.all()
         qdata = {'q__price': '100'}
@@ -134,6 +477,57 @@ class QSTests(TestCase):
         self.assertEqual(0, qs.count())
 
 
+class SearchTests(TransactionTestCase):
+    # FTS5 tables can not be created in the transaction of TestCase
+    def setUp(self):
+        self.backend = SqliteFTSSearchBackend()
+        register_search_index(
+            Book, ['name', 'descn', 'category__name', 'authors__name'], self.backend)
+        create_books()
+
+    def tearDown(self):
+        unregister_search_index(Book)
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % self.backend.get_table(Book))
+
+    def test_sqlite_fts(self):
+        from django.core.management import call_command
+        books = Book.objects.all()
+
+        def search(kw):
+            qdata = {'q_quick_search_kw': kw}
+            return sorted(e.name for e in do_filter(books, qdata, ['name'], ['price']))
+        # not built, icontains
+        self.assertEqual(['book-01'], search('author-02'))
+        Book.objects.get(name='book-02').save()
+        call_command('rebuildsearchindex', 'tests.book', stdout=open(os.devnull, 'w'))
+        self.assertEqual(['book-01', 'book-02', 'book-03'], search('boo'))
+        self.assertEqual(['book-01', 'book-02'], search('catego'))
+        self.assertEqual(['book-01'], search('author-02'))
+        self.assertEqual(['book-02'], search('200'))
+        self.assertEqual(['book-01', 'book-02', 'book-03'], sorted(e.name for e in do_filter(books, {})))
+        Book.objects.create(name='new "book"')
+        self.assertEqual(['book-01', 'book-02', 'book-03', 'new "book"'], search('"book"'))
+        Book.objects.get(name='book-03').delete()
+        self.assertEqual(['book-01', 'book-02', 'new "book"'], search('book'))
+        author = Author.objects.get(name='author-03')
+        Book.objects.get(name='book-02').authors.add(author)
+        self.assertEqual(['book-02'], search('author-03'))
+        author.book_set.add(Book.objects.get(name='book-01'))
+        self.assertEqual(['book-01', 'book-02'], search('author-03'))
+        author.book_set.clear()
+        self.assertEqual([], search('author-03'))
+        Book.objects.get(name='book-01').authors.remove(Author.objects.get(name='author-02'))
+        self.assertEqual([], search('author-02'))
+
+    def test_icontains_backend(self):
+        unregister_search_index(Book)
+        register_search_index(Book, ['name', 'category__name'], get_search_backend())
+        qs = do_filter(Book.objects.all(), {'q_quick_search_kw': 'ook-0'}, ['name'])
+        self.assertEqual(3, qs.count())
+        self.assertEqual(['tests.Book'], [e._meta.label for e in search_indexes])
+
+
 @skipUnless(django.VERSION >= (1, 10, 0), "JustSelected* only support Django >= 1.10")
 class FormTests(TestCase):
     def setUp(self):
@@ -287,3 +681,350 @@ class XlsxUtilsTests(TestCase):
         titles = ['name', 'price']
         response = simple_export2xlsx('fn.xlsx', titles, qs, func_data)
         self.assertTrue(response is not None)
+
+    def test_simple_export2xlsx_streaming(self):
+        qs = Book.objects.all()
+        titles = ['name', 'price']
+        response = simple_export2xlsx(
+            'fn', titles, qs, lambda o: [o.name, o.price], streaming=True)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        self.assertEqual(b'PK', content[:2])
+
+    def test_iter_export_rows(self):
+        create_books()
+        qs = Book.objects.all()
+        rows = list(iter_export_rows(qs, lambda o: [o.name], chunk_size=2))
+        self.assertEqual([['book-01'], ['book-02'], ['book-03']], rows)
+        self.assertIsNone(qs._result_cache)
+        rows = list(iter_export_rows(qs, columns=['name', 'category__name'], chunk_size=2))
+        self.assertEqual(('book-01', 'category-01'), rows[0])
+        rows = list(iter_export_rows(qs, lambda r: [r[0].upper()], columns=['name']))
+        self.assertEqual(['BOOK-03'], rows[2])
+        response = simple_export2xlsx('fn', ['name'], qs, columns=['name'], chunk_size=2)
+        self.assertTrue(response is not None)
+
+    def test_xlsw_write_rows(self):
+        import xlsxwriter
+        from io import BytesIO
+        wb = xlsxwriter.Workbook(BytesIO())
+        ws = wb.add_worksheet()
+        rows = [[1, 'a', True], [2.5, None, False]]
+        row_idx = xlsw_write_rows(ws, 1, rows, ['number', 'string', None])
+        self.assertEqual(3, row_idx)
+        self.assertEqual(1, ws.table[1][0].number)
+        self.assertFalse(1 in ws.table[2])
+        xlsw_write_rows(ws, 3, [[1, 2, 3]], ['number'])
+        self.assertEqual(3, ws.table[3][2].number)
+        wb.close()
+        create_books()
+        response = simple_export2xlsx(
+            'fn', ['name', 'price'], Book.objects.all(),
+            columns=['name', 'price'], col_types=['string', 'number'])
+        self.assertTrue(response is not None)
+
+    def test_simple_export2csv(self):
+        create_books()
+        qs = Book.objects.all()
+        response = simple_export2csv(
+            'fn', ['name', 'price'], qs, lambda o: [o.name, o.price])
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(content.startswith('\ufeffname,price\r\nbook-01,100.0\r\n'))
+        self.assertEqual(1, content.count('\ufeff'))
+        response = simple_export2csv(
+            'fn', ['名称'], qs, columns=['name'], delimiter='\t', encoding='gbk')
+        self.assertEqual('text/tab-separated-values', response['Content-Type'])
+        content = b''.join(response.streaming_content).decode('gbk')
+        self.assertEqual('名称\r\nbook-01\r\nbook-02\r\nbook-03\r\n', content)
+
+    def test_simple_export2xlsx_partitions(self):
+        create_books()
+        qs = Book.objects.all()
+        pks = sorted(qs.values_list('pk', flat=True))
+        ranges = pk_ranges(qs, 2)
+        self.assertEqual(pks[0], ranges[0][0])
+        self.assertEqual(pks[-1] + 1, ranges[-1][1])
+        self.assertEqual([], pk_ranges(qs.none(), 2))
+        parts = list(iter_partitioned_rows(
+            qs, 'lbutils.tests.tests.export_book_row', processes=1, partitions=3))
+        self.assertEqual((0, [['book-01', 100.0]]), parts[0])
+        self.assertEqual(3, sum(len(e[1]) for e in parts))
+        parts = list(iter_partitioned_rows(qs, columns=['name'], processes=1, partitions=1, chunk_size=2))
+        self.assertEqual([0, 0], [e[0] for e in parts])
+        self.assertEqual([2, 1], [len(e[1]) for e in parts])
+        # workers can not see the data of the transaction
+        with self.assertLogs('lbutils.xlsxutils', 'WARNING'):
+            parts = list(iter_partitioned_rows(qs, columns=['name'], processes=2))
+        self.assertEqual(3, sum(len(e[1]) for e in parts))
+        response = simple_export2xlsx(
+            'fn', ['name'], qs, columns=['name'], processes=1, partitions=2,
+            partition_sheets=True)
+        self.assertTrue(response is not None)
+        # bounds are read from the pks, sparse pks do not make empty tasks
+        Book.objects.create(pk=2 * 10 ** 8, name='book-04')
+        # pk range, the first pk of each partition, then the bound and the rows of each chunk
+        with self.assertNumQueries(1 + 3 + 2 * 3):
+            parts = list(iter_partitioned_rows(qs, columns=['name'], processes=1, partitions=3, chunk_size=2))
+        self.assertEqual([(0, 2), (0, 1), (2, 1)], [(e[0], len(e[1])) for e in parts])
+
+    def test_xlsw_write_sheet_pipelined(self):
+        import xlsxwriter
+        from io import BytesIO
+        wb = xlsxwriter.Workbook(BytesIO())
+        rows = ([i, 'name-%s' % i] for i in range(25))
+        xlsw_write_sheet_pipelined(wb, 'sheet', ['id', 'name'], rows, chunk_size=10, queue_size=1)
+        wb.close()
+        self.assertEqual(['sheet'], [e.name for e in wb.worksheets()])
+        self.assertEqual(24, wb.worksheets()[0].table[25][0].number)
+        wb = xlsxwriter.Workbook(BytesIO())
+        with self.assertRaises(TypeError):
+            xlsw_write_sheet_pipelined(
+                wb, 'sheet', ['id'], ([i] for i in range(25)), col_types=['string'], chunk_size=2)
+        create_books()
+        response = simple_export2xlsx(
+            'fn', ['name'], Book.objects.all(), lambda o: [o.category and o.category.name],
+            chunk_size=2, pipeline=True)
+        self.assertTrue(response is not None)
+
+    def test_simple_export2xlsx_cache(self):
+        import tempfile
+        create_books()
+        qs = Book.objects.filter(is_active=True)
+        with tempfile.TemporaryDirectory() as tmp_dir, self.settings(LBUTILS_EXPORT_CACHE_DIR=tmp_dir):
+            with self.assertNumQueries(1):
+                response = simple_export2xlsx('fn', ['name'], qs, columns=['name'], cache_ttl=60)
+                content = b''.join(response.streaming_content)
+            with self.assertNumQueries(0):
+                response = simple_export2xlsx('fn', ['name'], qs, columns=['name'], cache_ttl=60)
+                self.assertEqual(content, b''.join(response.streaming_content))
+            key = export_cache_key('fn', ['name'], qs, None, ['name'], None, None, None, None, False, None)
+            self.assertTrue(get_cached_export(key, 60))
+            self.assertFalse(get_cached_export(key, -1))
+            Book.objects.create(name='book-04')
+            key = export_cache_key('fn', ['name'], qs, None, ['name'], None, None, None, None, False, None)
+            self.assertFalse(get_cached_export(key, 60))
+            with self.assertNumQueries(1):
+                simple_export2xlsx('fn', ['name'], qs, columns=['name'], cache_ttl=60)
+            simple_export2xlsx('fn', ['name'], qs, lambda o: [o.name], cache_ttl=60)
+            simple_export2xlsx('fn', ['name'], qs, lambda o: [o.pk], cache_ttl=60)
+            simple_export2xlsx('fn', ['name'], qs, columns=['name'], col_types=['string'], cache_ttl=60)
+            self.assertEqual(6, len(os.listdir(tmp_dir)))  # tmp, 5 files
+            with self.assertRaises(ZeroDivisionError):
+                simple_export2xlsx('fn', ['name'], qs, lambda o: [1 / 0], cache_ttl=60)
+            self.assertEqual([], os.listdir(os.path.join(tmp_dir, 'tmp')))
+            with open(os.path.join(tmp_dir, 'tmp', 'crashed'), 'w'):
+                pass
+            evict_export_cache(max_size=0, ttl=-1)
+            self.assertEqual(['tmp'], os.listdir(tmp_dir))
+            self.assertEqual([], os.listdir(os.path.join(tmp_dir, 'tmp')))
+
+    def test_simple_import_xlsx(self):
+        import xlsxwriter
+        from io import BytesIO
+        output = BytesIO()
+        wb = xlsxwriter.Workbook(output)
+        ws = wb.add_worksheet()
+        rows = [['name', 'price'], ['book-01', 1], ['', 2], [None, None], ['book-02', 'x'], ['book-03', 3]]
+        xlsw_write_rows(ws, 0, rows, [None, None])
+        wb.close()
+        output.seek(0)
+
+        def func_row(row):
+            return {'name': row[0] or '', 'price': float(row[1])}
+        created, errors = simple_import_xlsx(output, Book, func_row, batch_size=1)
+        self.assertEqual(2, created)
+        self.assertEqual([3, 5], [e[0] for e in errors])
+        self.assertEqual(['book-01', 'book-03'], [e.name for e in Book.objects.all()])
+
+        def func_row(row):
+            return Book(name=row[0] or None, price=row[2])  # IndexError
+        created, errors = simple_import_xlsx(output, Book, func_row)
+        self.assertEqual((0, [2, 3, 5, 6]), (created, [e[0] for e in errors]))
+
+        def func_row(row):
+            return Book(name=row[0] or None)  # name is not null
+        created, errors = simple_import_xlsx(output, Book, func_row, validate=False)
+        self.assertEqual(3, created)
+        self.assertEqual([3], [e[0] for e in errors])
+        self.assertIn('NOT NULL', errors[0][1])
+
+    def test_simple_export2xlsx_summaries(self):
+        import xlsxwriter
+        from io import BytesIO
+        from django.db.models import Count, Max, Sum
+        create_books()
+        qs = Book.objects.all()
+        wb = xlsxwriter.Workbook(BytesIO())
+        aggregates = {'total': Sum('price'), 'books': Count('pk'), 'max': Max('price')}
+        with self.assertNumQueries(1):
+            ws = xlsw_write_summary(wb, qs, 'by category', ['category__name'], aggregates)
+        self.assertFalse(0 in ws.table[1])  # books without category
+        self.assertEqual(300, ws.table[2][1].number)
+        self.assertEqual(2, ws.table[2][2].number)
+        ws = xlsw_write_summary(wb, qs, 'total', [], aggregates)
+        self.assertEqual(3, ws.table[1][1].number)
+        wb.close()
+        response = simple_export2xlsx(
+            'fn', ['name'], qs, columns=['name'], summaries=[('total', [], aggregates)])
+        self.assertTrue(response is not None)
+
+
+def export_book_row(o):
+    return [o.name, o.price]
+
+
+class ExportJobsTests(TestCase):
+    def setUp(self):
+        import tempfile
+        create_books()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.settings = self.settings(LBUTILS_EXPORT_ROOT=self.tmpdir.name)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.tmpdir.cleanup()
+
+    def test_export_job(self):
+        from django.test import RequestFactory
+        qs = Book.objects.filter(is_active=True)
+        job_id = enqueue_export(
+            'books', ['name', 'price'], qs, 'lbutils.tests.tests.export_book_row')
+        self.assertEqual('pending', get_export_job(job_id)['status'])
+        jobs = run_export_jobs()
+        self.assertEqual(['done'], [e['status'] for e in jobs])
+        self.assertEqual([], run_export_jobs())
+        request = RequestFactory().get('/')
+        response = export_job_status(request, job_id)
+        self.assertTrue(b'"done"' in response.content)
+        response = export_job_download(request, job_id)
+        self.assertEqual(b'PK', b''.join(response.streaming_content)[:2])
+
+    def test_export_job_failed(self):
+        from django.core.management import call_command
+        job_id = enqueue_export('books', ['name'], Book.objects.all(), columns=['not_exist'])
+        with self.assertLogs('lbutils.exportjobs', 'ERROR'):
+            call_command('runexportjobs', processes=0, once=True, stdout=open(os.devnull, 'w'))
+        job = get_export_job(job_id)
+        self.assertEqual('failed', job['status'])
+        self.assertTrue(job['error'])
+        with self.assertRaises(Http404):
+            export_job_download(None, '../x')
+
+    def test_export_job_signature(self):
+        import json
+        job_id = enqueue_export('books', ['name'], Book.objects.all(), columns=['name'])
+        path = os.path.join(self.tmpdir.name, '%s.json' % job_id)
+        with open(path) as f:
+            job = json.load(f)
+        job['func_data'] = 'os.system'
+        with open(path, 'w') as f:
+            json.dump(job, f)
+        with self.assertLogs('lbutils.exportjobs', 'ERROR'):
+            self.assertEqual(['failed'], [e['status'] for e in run_export_jobs()])
+        self.assertIn('signature', get_export_job(job_id)['error'])
+
+    def test_export_job_recover_and_cleanup(self):
+        import time
+        job_id = enqueue_export('books', ['name'], Book.objects.all(), columns=['name'])
+        lock_path = os.path.join(self.tmpdir.name, '%s.lock' % job_id)
+        job = get_export_job(job_id)
+        job.update(status='running', attempts=1)
+        with open(os.path.join(self.tmpdir.name, '%s.json' % job_id), 'w') as f:
+            import json
+            json.dump(job, f)
+        open(lock_path, 'w').close()
+        self.assertEqual([], recover_export_jobs())
+        os.utime(lock_path, (time.time() - 3600, time.time() - 3600))
+        with self.assertLogs('lbutils.exportjobs', 'WARNING'):
+            jobs = run_export_jobs()
+        self.assertEqual(['done'], [e['status'] for e in jobs])
+        self.assertEqual(2, get_export_job(job_id)['attempts'])
+        self.assertEqual([], cleanup_export_jobs())
+        self.assertEqual([job_id], cleanup_export_jobs(max_age=0))
+        self.assertEqual([], os.listdir(self.tmpdir.name))
+
+    def test_export_root_permissions(self):
+        from django.core.exceptions import ImproperlyConfigured
+        path = os.path.join(self.tmpdir.name, 'shared')
+        os.makedirs(path, 0o777)
+        os.chmod(path, 0o777)
+        with self.assertRaises(ImproperlyConfigured):
+            private_dir(path)
+        with self.assertRaises(ImproperlyConfigured):
+            private_dir(path, shared=True)
+        path = private_dir(os.path.join(self.tmpdir.name, 'private'))
+        self.assertEqual(0o700, os.stat(path).st_mode & 0o777)
+
+    def test_export_watermark(self):
+        qs = Book.objects.all()
+        response = simple_export2csv('books', ['name'], qs, columns=['name'], watermark='pk')
+        content = b''.join(response.streaming_content).decode('utf-8-sig')
+        self.assertEqual(4, len(content.splitlines()))
+        self.assertEqual(Book.objects.get(name='book-03').pk, get_export_watermark('books')[1])
+        response = simple_export2csv('books', ['name'], qs, columns=['name'], watermark='pk')
+        self.assertEqual(1, len(b''.join(response.streaming_content).splitlines()))
+        Book.objects.create(name='book-04')
+        rows = list(iter_delta_rows('books', qs, 'pk', lambda o: [o.name]))
+        self.assertEqual([['book-04']], rows)
+        self.assertEqual([], list(iter_delta_rows('books', qs, 'pk')))
+        set_export_watermark('books', None)
+        self.assertEqual(None, get_export_watermark('books'))
+        response = simple_export2xlsx('books', ['name'], qs, columns=['name'], watermark='price')
+        self.assertEqual(200, get_export_watermark('books')[0])
+        # the watermark is not saved if the file is not built
+        Book.objects.create(name='book-05', price=300)
+        with self.assertRaises(FieldError):
+            simple_export2xlsx(
+                'books', ['name'], qs, columns=['name'], watermark='price', summaries=[('s', ['xx'], {})])
+        self.assertEqual(200, get_export_watermark('books')[0])
+        with self.assertRaises(ValueError):
+            simple_export2csv('book list', ['name'], qs, columns=['name'], watermark='pk')
+        with self.assertRaises(ValueError):
+            simple_export2xlsx('books', ['name'], qs, columns=['name'], watermark='pk', processes=2)
+
+
+class ReadReplicaTests(TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        create_books()
+        Book.objects.using('replica').create(name='replica-01', price=5)
+        unpin_primary()
+        self.addCleanup(unpin_primary)
+
+    def test_read_replica(self):
+        qs = Book.objects.all()
+        self.assertEqual(5, get_sum(qs, 'price', using='replica'))
+        self.assertEqual(300, get_sum(qs, 'price'))
+        with self.settings(LBUTILS_READ_DB='replica'):
+            self.assertEqual(5, get_max(qs, 'price'))
+            self.assertEqual(300, get_sum(qs.using('default'), 'price'))
+            response = simple_export2csv('books', ['name'], qs, columns=['name'])
+            content = b''.join(response.streaming_content).decode('utf-8-sig')
+            self.assertEqual(['name', 'replica-01'], content.splitlines())
+            Book.objects.create(name='book-04', price=1)
+            self.assertFalse(is_primary_pinned())  # not in a scope
+            with primary_pin_scope():
+                Book.objects.using('replica').create(name='replica-02', price=2)
+                self.assertFalse(is_primary_pinned())  # not the primary database
+                Book.objects.create(name='book-05', price=1)
+                self.assertTrue(is_primary_pinned())
+                self.assertEqual(302, get_sum(qs, 'price'))
+            self.assertFalse(is_primary_pinned())
+            middleware = ReadReplicaMiddleware(lambda request: get_max(qs, 'price'))
+            self.assertEqual(5, middleware(None))
+            middleware = ReadReplicaMiddleware(
+                lambda request: [Book.objects.create(name='book-06'), get_max(qs, 'price')][1])
+            self.assertEqual(200, middleware(None))
+            self.assertFalse(is_primary_pinned())
+            pin_primary()
+            self.assertEqual(200, get_max(qs, 'price'))
+
+    def test_planner_timed_replica(self):
+        planner = FilterPlanner(slow_ms=0, explain=False)
+        with self.assertLogs('lbutils.planner', 'WARNING') as logs:
+            qs = do_filter(Book.objects.using('replica'), {'q__name': 'replica-01'}, planner=planner)
+            with planner.timed(qs):
+                self.assertEqual(1, len(qs))
+        self.assertIn('slow filter', logs.output[-1])
@@ -1,19 +1,54 @@
 import codecs
+import collections
+import csv
+import functools
+import itertools
+import logging
+import math
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from io import BytesIO
+from io import BytesIO, StringIO
 
-from django.http import HttpResponse
+from django.apps import apps
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connections, router, transaction
+from django.db.models import Max, Min
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+from .exportcache import (export_cache_key, get_cached_export,
+                          new_export_cache_file, save_cached_export)
+from .exportdelta import iter_delta_rows
+from .qs import auto_related as _auto_related
+from .qs import dump_queryset, load_queryset
+from .routing import read_qs
+from .utils import as_callable
 
 try:
     import xlsxwriter as xlwt
 except ImportError:
     pass
 
+try:
+    import openpyxl
+except ImportError:
+    pass
+
 
 __all__ = (
-    'export_xlsx', 'xlsw_write_row', 'simple_export2xlsx',
+    'export_xlsx', 'export_file', 'export_xlsx_file', 'xlsw_write_row', 'xlsw_write_rows',
+    'xlsw_write_sheet', 'xlsw_write_summary', 'iter_export_rows', 'init_export_worker', 'pk_ranges',
+    'iter_partitioned_rows', 'xlsw_write_sheet_pipelined', 'simple_export2xlsx',
+    'iter_csv', 'simple_export2csv', 'iter_xlsx_rows', 'simple_import_xlsx',
 )
 
+logger = logging.getLogger(__name__)
+
+XLSX_CONTENT_TYPE = "application/vnd.ms-excel"
+
 
 def export_xlsx(wb, output, fn):
     """
@@ -23,13 +58,36 @@ def export_xlsx(wb, output, fn):
     fn: file name
     """
     wb.close()
-    output.seek(0)
-    response = HttpResponse(output.read(), content_type="application/vnd.ms-excel")
+    response = HttpResponse(output.getvalue(), content_type=XLSX_CONTENT_TYPE)
+    cd = codecs.encode('attachment;filename=%s' % fn, 'utf-8')
+    response['Content-Disposition'] = cd
+    return response
+
+
+def export_file(fp, fn, content_type=XLSX_CONTENT_TYPE):
+    """
+    send a file as attachment, the file is streamed in chunks
+    fp: a binary file object, closed after the response is sent
+    fn: file name
+    """
+    response = FileResponse(fp, content_type=content_type)
     cd = codecs.encode('attachment;filename=%s' % fn, 'utf-8')
     response['Content-Disposition'] = cd
     return response
 
 
+def export_xlsx_file(wb, fp, fn):
+    """
+    export as excel, stream the file in chunks
+    wb:
+    fp: a binary file object the workbook is written to, closed after the response is sent
+    fn: file name
+    """
+    wb.close()
+    fp.seek(0)
+    return export_file(fp, fn)
+
+
 def xlsw_write_row(ws, row_idx, row, fmt=None):
     """
     ws:
@@ -43,22 +101,543 @@ def xlsw_write_row(ws, row_idx, row, fmt=None):
     return row_idx
 
 
-def simple_export2xlsx(filename, titles, qs, func_data):
+def xlsw_col_writers(ws, col_types):
     """
-    export as excel
-    filename: file name
-    titles: title for this table
+    resolve the write method of each column once.
+
+    The private `_write_<type>` methods skip the cell notation conversion
+    of the public ones, fallback to the public methods if not available.
+    """
+    writers = []
+    for col_type in col_types:
+        if not col_type:
+            writers.append(ws.write)
+            continue
+        writer = getattr(ws, '_write_%s' % col_type, None)
+        writers.append(writer or getattr(ws, 'write_%s' % col_type))
+    return writers
+
+
+def xlsw_write_rows(ws, row_idx, rows, col_types, col_fmts=None):
+    """
+    write a block of rows, the write method of each column is resolved once.
+
+    ws:
+    row_idx: row number of the first row
+    rows: iterable of list, data to write
+    col_types: type for each column, 'number', 'string', 'datetime', 'boolean'
+        or None(dispatch by `ws.write`). ex: `['number', 'string', None]`
+        A 'string' column is written as is, no formula/url/number conversion.
+    col_fmts: format for each column
+    return: next row number
+
+    The cells after the columns of col_types are written by `ws.write`.
+    """
+    blank = getattr(ws, '_write_blank', None) or ws.write_blank
+    col_fmts = col_fmts or [None] * len(col_types)
+    cols = list(zip(range(len(col_types)), xlsw_col_writers(ws, col_types), col_fmts))
+    n_cols = len(cols)
+    for row in rows:
+        for (col_idx, writer, fmt), value in zip(cols, row):
+            if value is None:
+                blank(row_idx, col_idx, None, fmt)
+            else:
+                writer(row_idx, col_idx, value, fmt)
+        if len(row) > n_cols:
+            for col_idx, value in enumerate(row[n_cols:], n_cols):
+                ws.write(row_idx, col_idx, value)
+        row_idx += 1
+    return row_idx
+
+
+def iter_export_rows(
+        qs, func_data=None, columns=None, chunk_size=None, auto_related=False,
+        watermark=None, watermark_name=None, save_watermark=True):
+    """
+    iterate the rows to export
     qs: queryset to export
-    func_data: a function to format object to list. ex: `lambda o: [o.pk, o.name]`
+    func_data: a function to format object to list.
+        if columns is set, it gets the values tuple instead of the object.
+    columns: field names, rows are fetched with `values_list` and written as is,
+        no model instance is created. ex: `['pk', 'name', 'category__name']`
+    chunk_size: iterate with `qs.iterator(chunk_size=chunk_size)`,
+        the queryset result cache is not filled.
+    auto_related: add select_related/prefetch_related for the relations
+        accessed by func_data, see `lbutils.qs.auto_related`
+    watermark: only export the rows newer than the last export, ex: 'updated_at'.
+        see `lbutils.exportdelta.iter_delta_rows`
+    watermark_name: export name the watermark is saved for
+    save_watermark: see `save` of `lbutils.exportdelta.iter_delta_rows`
+    """
+    if auto_related and func_data is not None and not columns:
+        qs = _auto_related(qs, func_data)
+    if watermark:
+        return iter_delta_rows(watermark_name, qs, watermark, func_data, columns, chunk_size, save_watermark)
+    if columns:
+        qs = qs.values_list(*columns)
+    if chunk_size:
+        qs = qs.iterator(chunk_size=chunk_size)
+    if func_data is None:
+        return iter(qs)
+    return (func_data(o) for o in qs)
+
+
+_inherited_connections = []
+
+
+def init_export_worker():
+    """ initializer for export worker processes """
+    import django
+    if not apps.ready:
+        django.setup()
+    for conn in connections.all():
+        if conn.connection is not None:
+            # a forked worker shares the socket of the parent's connection,
+            # closing it would end the session of the parent.
+            _inherited_connections.append(conn.connection)
+            conn.connection = None
+
+
+def pk_ranges(qs, partitions):
+    """
+    split the queryset into integer primary key ranges.
+
+    return: list of (start, end), `start <= pk < end`
+    """
+    pks = qs.aggregate(start=Min('pk'), end=Max('pk'))
+    if pks['start'] is None:
+        return []
+    start, end = pks['start'], pks['end'] + 1
+    step = int(math.ceil((end - start) / float(partitions)))
+    return [(e, min(e + step, end)) for e in range(start, end, step)]
+
+
+def _render_partition(data, func_data, columns, start, end):
+    qs = load_queryset(data).filter(pk__gte=start, pk__lt=end)
+    if func_data is not None:
+        func_data = as_callable(func_data)
+    return [list(e) for e in iter_export_rows(qs, func_data, columns)]
+
+
+def _pk_chunks(qs, start, end, chunk_size):
+    """
+    split `start <= pk < end` into ranges of at most chunk_size rows of qs,
+    the bounds are the pks of every chunk_size-th row, so sparse pks do not
+    make empty ranges, an empty range has no chunk.
+    """
+    pks = qs.order_by('pk').values_list('pk', flat=True)
+    first = list(pks.filter(pk__gte=start, pk__lt=end)[:1])
+    if not first:
+        return
+    start = first[0]
+    while True:
+        bound = list(pks.filter(pk__gte=start, pk__lt=end)[chunk_size:chunk_size + 1])
+        if not bound:
+            yield start, end
+            return
+        yield start, bound[0]
+        start = bound[0]
+
+
+def _map_bounded(executor, func, tasks, window):
+    """
+    like `executor.map`, but at most window tasks are submitted and not yet consumed.
+
+    tasks: iterable of (tag, args), consumed lazily
+    return: iterator of (tag, result)
+    """
+    tasks = iter(tasks)
+    pending = collections.deque()
+    for tag, args in itertools.islice(tasks, window):
+        pending.append((tag, executor.submit(func, *args)))
+    while pending:
+        tag, future = pending.popleft()
+        result = future.result()
+        for next_tag, args in itertools.islice(tasks, 1):
+            pending.append((next_tag, executor.submit(func, *args)))
+        yield tag, result
+
+
+def iter_partitioned_rows(
+        qs, func_data=None, columns=None, processes=None, partitions=None, chunk_size=2000):
+    """
+    fetch and format rows by primary key ranges in a process pool.
+
+    Rows are ordered by the pk range first, then by the ordering of qs.
+    Each partition is fetched in pk ranges of chunk_size rows, the bounds are
+    read from the pks of qs, and at most `processes * 2` tasks are waiting to be consumed.
+    Runs in this process if processes is 1 or the database connection is in a
+    transaction(ex: ATOMIC_REQUESTS), workers can not see its uncommitted data.
+    qs: queryset to export, must have an integer primary key
+    func_data: path of a function to format object to list, or a picklable
+        (module level) function. ex: "app.exports.book_row"
+    columns: see `iter_export_rows`
+    processes: number of worker processes
+    partitions: number of pk ranges, default is `processes * 4`
+    chunk_size: rows of a task
+    return: iterator of (partition index, list of rows)
+    """
+    partitions = partitions or (processes or 1) * 4
+    chunk_size = chunk_size or 2000
+    tasks = (
+        (idx, bounds)
+        for idx, (start, end) in enumerate(pk_ranges(qs, partitions))
+        for bounds in _pk_chunks(qs, start, end, chunk_size))
+    render = functools.partial(_render_partition, dump_queryset(qs), func_data, columns)
+    if processes != 1 and connections[qs.db].in_atomic_block:
+        logger.warning('export runs in this process, the connection is in a transaction')
+        processes = 1
+    if processes == 1:
+        for idx, bounds in tasks:
+            yield idx, render(*bounds)
+        return
+    with ProcessPoolExecutor(processes, initializer=init_export_worker) as executor:
+        for idx, rows in _map_bounded(executor, render, tasks, processes * 2):
+            yield idx, rows
+
+
+def xlsw_write_sheet(wb, sheet_name, titles, rows, col_types=None, col_fmts=None):
     """
-    output = BytesIO()
-    wb = xlwt.Workbook(output)
-    ws = wb.add_worksheet(filename)
+    add a worksheet with a title row and the data rows
+    wb:
+    sheet_name: name of the worksheet
+    titles: title for this table
+    rows: iterable of list, data to write
+    col_types: write rows with `xlsw_write_rows`, see `xlsw_write_rows`
+    col_fmts: see `xlsw_write_rows`
+    return: the worksheet
+    """
+    ws = wb.add_worksheet(sheet_name)
     header_fmt = wb.add_format()
     header_fmt.set_bg_color('#C4D89E')
     row_idx = 0
     row_idx = xlsw_write_row(ws, row_idx, titles, header_fmt)
-    for o in qs:
-        row_idx = xlsw_write_row(ws, row_idx, func_data(o))
+    if col_types:
+        row_idx = xlsw_write_rows(ws, row_idx, rows, col_types, col_fmts)
+    else:
+        for row in rows:
+            row_idx = xlsw_write_row(ws, row_idx, row)
+    return ws
+
+
+def _iter_queue(q):
+    while True:
+        chunk = q.get()
+        if chunk is None:
+            return
+        for row in chunk:
+            yield row
+
+
+def xlsw_write_sheet_pipelined(
+        wb, sheet_name, titles, rows, col_types=None, col_fmts=None,
+        chunk_size=1000, queue_size=4):
+    """
+    same as `xlsw_write_sheet`, but the cells are written by a writer thread
+    while the next rows are fetched and formatted in this thread.
+
+    DB access(include the lazy relations in func_data) stays in this thread,
+    so the connection and transaction of the caller are used.
+    chunk_size: rows passed to the writer thread at a time
+    queue_size: max chunks waiting to be written
+    """
+    q = queue.Queue(queue_size)
+    errors = []
+
+    def write():
+        try:
+            xlsw_write_sheet(wb, sheet_name, titles, _iter_queue(q), col_types, col_fmts)
+        except Exception as e:
+            errors.append(e)
+            while q.get() is not None:  # unblock the reader
+                pass
+
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    rows = iter(rows)
+    try:
+        while not errors:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            q.put(chunk)
+    finally:
+        q.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
+def xlsw_write_summary(wb, qs, sheet_name, group_by, aggregates):
+    """
+    add a summary sheet, computed with one grouped query.
+
+    wb:
+    qs: queryset to summarize
+    sheet_name: name of the worksheet
+    group_by: field names to group by, [] for totals of the whole qs
+    aggregates: dict of title and aggregate. ex: `{'total': Sum('price'), 'books': Count('pk')}`
+    return: the worksheet
+    """
+    group_by = list(group_by)
+    titles = group_by + list(aggregates)
+    if group_by:
+        rows = qs.order_by().values_list(*group_by).annotate(**aggregates).order_by(*group_by)
+    else:
+        result = qs.aggregate(**aggregates)
+        rows = [[result[e] for e in aggregates]]
+    return xlsw_write_sheet(wb, sheet_name, titles, rows)
+
+
+def _write_export(
+        wb, filename, titles, qs, func_data, chunk_size, columns, col_types, col_fmts,
+        processes, partitions, partition_sheets, pipeline, auto_related,
+        watermark, watermark_name, summaries):
+    write_sheet = xlsw_write_sheet_pipelined if pipeline else xlsw_write_sheet
+    summary_qs = qs
+    if processes:
+        if auto_related and func_data is not None and not columns:
+            qs = _auto_related(qs, as_callable(func_data))
+        parts = iter_partitioned_rows(qs, func_data, columns, processes, partitions, chunk_size)
+        if partition_sheets:
+            for idx, chunks in itertools.groupby(parts, key=lambda e: e[0]):
+                sheet_name = '%s-%s' % (filename, idx + 1)
+                rows = itertools.chain.from_iterable(e[1] for e in chunks)
+                write_sheet(wb, sheet_name, titles, rows, col_types, col_fmts)
+        else:
+            rows = itertools.chain.from_iterable(e[1] for e in parts)
+            write_sheet(wb, filename, titles, rows, col_types, col_fmts)
+    else:
+        rows = iter_export_rows(
+            qs, func_data, columns, chunk_size, auto_related,
+            watermark, watermark_name or filename, save_watermark=False)
+        write_sheet(wb, filename, titles, rows, col_types, col_fmts)
+    for summary in summaries or []:
+        xlsw_write_summary(wb, summary_qs, *summary)
+    return rows if watermark else None
+
+
+def simple_export2xlsx(
+        filename, titles, qs, func_data=None, streaming=False,
+        chunk_size=None, columns=None, col_types=None, col_fmts=None,
+        processes=None, partitions=None, partition_sheets=False, pipeline=False,
+        auto_related=False, cache_ttl=None, watermark=None, watermark_name=None,
+        summaries=None, using=None):
+    """
+    export as excel
+    filename: file name
+    titles: title for this table
+    qs: queryset to export
+    func_data: a function to format object to list. ex: `lambda o: [o.pk, o.name]`
+    streaming: build the workbook in constant memory mode on a temporary file
+        and stream it, memory usage will not grow with the number of rows.
+    chunk_size: see `iter_export_rows`
+    columns: see `iter_export_rows`
+    col_types: write rows with `xlsw_write_rows`, see `xlsw_write_rows`
+    col_fmts: see `xlsw_write_rows`
+    processes: fetch and format rows in a process pool, see `iter_partitioned_rows`
+    partitions: see `iter_partitioned_rows`
+    partition_sheets: write each partition to its own sheet
+    pipeline: write cells in a writer thread while the rows are fetched,
+        see `xlsw_write_sheet_pipelined`
+    auto_related: see `iter_export_rows`
+    cache_ttl: seconds to keep the file in the export cache, repeated
+        exports of the same data are served from the cached file.
+        The file is built as in streaming mode. see `lbutils.exportcache`
+    watermark: see `iter_export_rows`, the file is not cached, the watermark is saved
+        after the file is built. raise ValueError if processes is set.
+    watermark_name: see `iter_export_rows`, default is filename
+    summaries: list of (sheet_name, group_by, aggregates), summary sheets
+        added after the data sheet, see `xlsw_write_summary`.
+        ex: `[('by category', ['category__name'], {'total': Sum('price')})]`
+    using: database alias to read, default is settings.LBUTILS_READ_DB, see `lbutils.routing.read_qs`
+    """
+    if watermark and processes:
+        raise ValueError('watermark can not be used with processes')
+    qs = read_qs(qs, using)
     fn = '%s-%s.xlsx' % (filename, datetime.now())
-    return export_xlsx(wb, output, fn)
+    write = functools.partial(
+        _write_export, filename=filename, titles=titles, qs=qs, func_data=func_data,
+        chunk_size=chunk_size, columns=columns, col_types=col_types, col_fmts=col_fmts,
+        processes=processes, partitions=partitions, partition_sheets=partition_sheets,
+        pipeline=pipeline, auto_related=auto_related,
+        watermark=watermark, watermark_name=watermark_name, summaries=summaries)
+    if cache_ttl and not watermark:
+        key = export_cache_key(
+            filename, titles, qs, func_data, columns, col_types, col_fmts,
+            processes, partitions, partition_sheets, summaries)
+        path = get_cached_export(key, cache_ttl)
+        if path is None:
+            with new_export_cache_file() as output:
+                try:
+                    wb = xlwt.Workbook(output, {'constant_memory': True})
+                    write(wb)
+                    wb.close()
+                except BaseException:
+                    output.close()
+                    os.remove(output.name)
+                    raise
+            path = save_cached_export(key, output.name)
+        return export_file(open(path, 'rb'), fn)
+    if streaming:
+        output = tempfile.TemporaryFile()
+        wb = xlwt.Workbook(output, {'constant_memory': True})
+        delta_rows = write(wb)
+        response = export_xlsx_file(wb, output, fn)
+    else:
+        output = BytesIO()
+        wb = xlwt.Workbook(output)
+        delta_rows = write(wb)
+        response = export_xlsx(wb, output, fn)
+    if delta_rows is not None:
+        delta_rows.save()  # the file is built
+    return response
+
+
+def iter_csv(titles, rows, delimiter=',', encoding='utf-8-sig', buffer_size=8192):
+    """
+    generate csv content as encoded chunks
+    titles: title for this table
+    rows: iterable of list, data to write
+    delimiter: ',' for csv, '\t' for tsv
+    encoding: the default 'utf-8-sig' adds a BOM so excel opens it as utf-8
+    buffer_size: yield when the buffered text is larger than this
+    """
+    encoder = codecs.getincrementalencoder(encoding)()
+    output = StringIO()
+    writer = csv.writer(output, delimiter=delimiter)
+    writer.writerow(titles)
+    for row in rows:
+        if output.tell() >= buffer_size:
+            yield encoder.encode(output.getvalue())
+            output.seek(0)
+            output.truncate()
+        writer.writerow(row)
+    yield encoder.encode(output.getvalue(), final=True)
+
+
+def simple_export2csv(
+        filename, titles, qs, func_data=None, delimiter=',',
+        encoding='utf-8-sig', chunk_size=2000, columns=None, auto_related=False,
+        watermark=None, watermark_name=None, using=None):
+    """
+    export as csv, rows are generated lazily into a streaming response
+    filename: file name
+    titles: title for this table
+    qs: queryset to export
+    func_data: a function to format object to list. ex: `lambda o: [o.pk, o.name]`
+    delimiter: see `iter_csv`
+    encoding: see `iter_csv`
+    chunk_size: see `iter_export_rows`
+    columns: see `iter_export_rows`
+    auto_related: see `iter_export_rows`
+    watermark: see `iter_export_rows`
+    watermark_name: see `iter_export_rows`, default is filename
+    using: see `simple_export2xlsx`
+    """
+    qs = read_qs(qs, using)
+    rows = iter_export_rows(
+        qs, func_data, columns, chunk_size, auto_related,
+        watermark, watermark_name or filename)
+    content_type, ext = "text/csv", 'csv'
+    if delimiter == '\t':
+        content_type, ext = "text/tab-separated-values", 'tsv'
+    response = StreamingHttpResponse(
+        iter_csv(titles, rows, delimiter, encoding), content_type=content_type)
+    fn = '%s-%s.%s' % (filename, datetime.now(), ext)
+    cd = codecs.encode('attachment;filename=%s' % fn, 'utf-8')
+    response['Content-Disposition'] = cd
+    return response
+
+
+def iter_xlsx_rows(fp, sheet=None, skip_rows=1):
+    """
+    iterate the rows of an excel in read-only mode, the file is not loaded
+    into memory.
+
+    fp: file name or file object
+    sheet: sheet name, default is the first sheet
+    skip_rows: number of title rows
+    yield: (row number, tuple of values)
+    """
+    wb = openpyxl.load_workbook(fp, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        for row_idx, row in enumerate(ws.iter_rows(values_only=True), 1):
+            if row_idx > skip_rows:
+                yield row_idx, row
+    finally:
+        wb.close()
+
+
+def _bulk_create(model_class, batch, errors):
+    """
+    create objects of batch, a list of (row number, object), if the batch
+    fails the objects are created one by one to find the failing rows.
+    """
+    using = router.db_for_write(model_class)
+    manager = model_class._default_manager
+    try:
+        with transaction.atomic(using=using):
+            manager.bulk_create([e[1] for e in batch])
+        return len(batch)
+    except DatabaseError as e:
+        if len(batch) == 1:
+            errors.append((batch[0][0], '%s' % e))
+            return 0
+    created = 0
+    for row_idx, obj in batch:
+        try:
+            with transaction.atomic(using=using):
+                manager.bulk_create([obj])
+            created += 1
+        except DatabaseError as e:
+            errors.append((row_idx, '%s' % e))
+    return created
+
+
+def simple_import_xlsx(
+        fp, model_class, func_row, batch_size=500, skip_rows=1, sheet=None,
+        validate=True):
+    """
+    import an excel with bulk_create
+    fp: file name or file object
+    model_class: model to create
+    func_row: a function to map the values of a row to a dict of fields or an
+        unsaved object, return None to skip the row.
+        an exception raised by it is reported as the error of the row.
+        ex: `lambda r: {'name': r[0], 'price': r[1]}`
+    batch_size: objects per bulk_create, each batch is created in a transaction,
+        the rows of a batch which fails are created one by one(in a savepoint
+        if in a transaction) and the database errors are reported.
+    skip_rows: see `iter_xlsx_rows`
+    sheet: see `iter_xlsx_rows`
+    validate: validate objects with `full_clean`(without unique check)
+    return: (number of created objects, list of (row number, error message))
+    """
+    created, errors, batch = 0, [], []
+    for row_idx, row in iter_xlsx_rows(fp, sheet, skip_rows):
+        if all(e is None for e in row):
+            continue
+        try:
+            obj = func_row(row)
+            if obj is None:
+                continue
+            if isinstance(obj, dict):
+                obj = model_class(**obj)
+            if validate:
+                obj.full_clean(validate_unique=False)
+        except ValidationError as e:
+            errors.append((row_idx, '; '.join(e.messages)))
+            continue
+        except Exception as e:
+            errors.append((row_idx, '%s' % e))
+            continue
+        batch.append((row_idx, obj))
+        if len(batch) >= batch_size:
+            created += _bulk_create(model_class, batch, errors)
+            batch = []
+    if batch:
+        created += _bulk_create(model_class, batch, errors)
+    return created, errors
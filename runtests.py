@@ -7,6 +7,7 @@ from django.conf import settings
 
 DEFAULT_SETTINGS = dict(
     INSTALLED_APPS=(
+        'django.contrib.contenttypes',
         'crispy_forms',
         'lbutils',
         'lbutils.tests',
@@ -29,9 +30,13 @@ DEFAULT_SETTINGS = dict(
     DATABASES={
         "default": {
             "ENGINE": "django.db.backends.sqlite3"
-        }
+        },
+        "replica": {
+            "ENGINE": "django.db.backends.sqlite3"
+        },
     },
     GET_SETTING='ABC',
+    SECRET_KEY='lbutils-tests',
     CRISPY_TEMPLATE_PACK='bootstrap3',
     SILENCED_SYSTEM_CHECKS=[],
 )
@@ -40,7 +40,10 @@ setup(
         ],
         'xlsxwriter': [
             'xlsxwriter>0.8',
-        ]
+        ],
+        'openpyxl': [
+            'openpyxl>=2.6',
+        ],
     },
     classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -57,7 +60,9 @@ setup(
         'Framework :: Django',
     ],
     zip_safe=False,
-    tests_require=["Django>=1.6.0", "django-crispy-forms>1.4", "xlsxwriter>0.8"],
+    tests_require=[
+        "Django>=1.6.0", "django-crispy-forms>1.4", "xlsxwriter>0.8", "openpyxl>=2.6",
+    ],
     test_suite='runtests.runtests',
     package_data={
         'lbutils': [